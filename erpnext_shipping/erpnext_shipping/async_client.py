@@ -0,0 +1,241 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+import asyncio
+import time
+import traceback
+from contextlib import AsyncExitStack
+
+import frappe
+import httpx
+
+from erpnext_shipping.erpnext_shipping import circuit_breaker, metrics, rate_limiter
+from erpnext_shipping.erpnext_shipping.http_client import (
+	BACKOFF_FACTOR,
+	IDEMPOTENT_METHODS,
+	MAX_BACKOFF,
+	RETRY_STATUS_CODES,
+	get_retries,
+	get_timeout,
+)
+
+# Provider calls in flight at the same time per provider, override with
+# `shipping_async_concurrency` in site config.
+DEFAULT_CONCURRENCY = 50
+
+
+class AsyncProviderClient:
+	"""Async counterpart of `http_client` for one provider.
+
+	All requests share one connection pool. At most `concurrency` requests are
+	in flight at the same time, the rest wait for a free slot.
+	"""
+
+	def __init__(
+		self,
+		provider: str,
+		auth=None,
+		concurrency: int | None = None,
+		priority: str = rate_limiter.INTERACTIVE,
+	):
+		connect_timeout, read_timeout = get_timeout()
+		concurrency = concurrency or get_concurrency()
+		self.provider = provider
+		self.account = rate_limiter.get_account(auth)
+		self.priority = priority
+		self.retries = get_retries()
+		self.semaphore = asyncio.Semaphore(concurrency)
+		self.client = httpx.AsyncClient(
+			auth=auth,
+			timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+			limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+			headers={"Accept-Encoding": "gzip, deflate"},
+		)
+
+	async def get(self, url: str, **kwargs) -> httpx.Response:
+		return await self.request("GET", url, **kwargs)
+
+	async def post(self, url: str, **kwargs) -> httpx.Response:
+		return await self.request("POST", url, **kwargs)
+
+	async def request(
+		self, method: str, url: str, idempotent=None, endpoint: str | None = None, **kwargs
+	) -> httpx.Response:
+		"""Send a request, handled like `http_client.request`."""
+		if idempotent is None:
+			idempotent = method.upper() in IDEMPOTENT_METHODS
+
+		circuit_breaker.check_circuit(self.provider)
+		try:
+			response = await self.send_with_retries(method, url, idempotent, endpoint, **kwargs)
+		except (httpx.TransportError, httpx.TimeoutException):
+			circuit_breaker.record_failure(self.provider)
+			raise
+
+		if response.status_code >= 500:
+			circuit_breaker.record_failure(self.provider)
+		else:
+			circuit_breaker.record_success(self.provider)
+
+		return response
+
+	async def send_with_retries(
+		self, method: str, url: str, idempotent: bool, endpoint: str | None, **kwargs
+	) -> httpx.Response:
+		for attempt in range(self.retries + 1):
+			is_last_attempt = attempt == self.retries
+			try:
+				async with self.semaphore:
+					await rate_limiter.acquire_async(self.provider, self.account, self.priority)
+					response = await self.send(endpoint, method, url, **kwargs)
+			except httpx.ConnectError:
+				if is_last_attempt:
+					raise
+			except (httpx.TransportError, httpx.TimeoutException):
+				if is_last_attempt or not idempotent:
+					raise
+			else:
+				if response.status_code == 429:
+					rate_limiter.throttle(self.provider, self.account, response.headers.get("Retry-After"))
+					if not is_last_attempt:
+						continue
+
+				if is_last_attempt or not idempotent or response.status_code not in RETRY_STATUS_CODES:
+					return response
+
+			await asyncio.sleep(min(BACKOFF_FACTOR * (2**attempt), MAX_BACKOFF))
+
+	async def send(self, endpoint: str | None, method: str, url: str, **kwargs) -> httpx.Response:
+		start = time.monotonic()
+		response = None
+		try:
+			response = await self.client.request(method, url, **kwargs)
+			return response
+		finally:
+			metrics.record(
+				self.provider,
+				endpoint,
+				time.monotonic() - start,
+				success=response is not None and response.is_success,
+			)
+
+	async def aclose(self):
+		await self.client.aclose()
+
+
+class AsyncProvider:
+	"""Common interface of the async provider engines.
+
+	Engines are registered via the `shipping_async_providers` hook and used as
+	async context managers, which open and close their connection pool.
+	"""
+
+	name = None
+	priority = rate_limiter.INTERACTIVE
+
+	def get_auth(self):
+		raise NotImplementedError
+
+	async def get_tracking_data(self, shipment_id: str) -> dict | None:
+		"""Return the tracking info of a Shipment, like the sync `get_tracking_data`."""
+		raise NotImplementedError
+
+	async def get_tracking_data_batch(self, shipment_ids: list[str]) -> dict:
+		"""Return {shipment id: tracking info or the exception raised while fetching it}.
+
+		Fetches each Shipment concurrently. Engines whose API returns many
+		shipments per request override this.
+		"""
+		results = await asyncio.gather(
+			*(self.get_tracking_data(shipment_id) for shipment_id in shipment_ids), return_exceptions=True
+		)
+		return dict(zip(shipment_ids, results))
+
+	async def __aenter__(self):
+		self.client = AsyncProviderClient(self.name, auth=self.get_auth(), priority=self.priority)
+		return self
+
+	async def __aexit__(self, *exc_info):
+		await self.client.aclose()
+
+
+def get_async_provider(provider: str) -> AsyncProvider | None:
+	methods = frappe.get_hooks("shipping_async_providers").get(provider)
+	return frappe.get_attr(methods[-1])() if methods else None
+
+
+def get_concurrency() -> int:
+	return frappe.conf.get("shipping_async_concurrency") or DEFAULT_CONCURRENCY
+
+
+def run_sync(coroutine):
+	"""Run a coroutine from synchronous code, e.g. a whitelisted method or a background job."""
+	return asyncio.run(coroutine)
+
+
+def call_sync(engine: AsyncProvider, method: str, *args):
+	"""Call one method of an async provider engine from synchronous code."""
+
+	async def call():
+		async with engine:
+			return await getattr(engine, method)(*args)
+
+	return run_sync(call())
+
+
+async def fetch_tracking_data(shipments: dict, priority: str = rate_limiter.BACKGROUND) -> dict:
+	"""Return {shipment: tracking info} for {shipment: (service provider, shipment id)}.
+
+	All provider calls run on one event loop. The Shipments of each provider
+	are passed to its engine together, so that engines can fetch many per
+	request. Failed calls are logged and return None, calls refused by an open
+	circuit only return None. Updates a user is waiting for pass
+	`priority=rate_limiter.INTERACTIVE`.
+	"""
+	async with AsyncExitStack() as stack:
+		engines = {}
+		for service_provider in {service_provider for service_provider, _shipment_id in shipments.values()}:
+			try:
+				engine = get_async_provider(service_provider)
+			except Exception:
+				# e.g. the provider has been disabled since its Shipments were booked
+				frappe.log_error(title="Shipping Error")
+				continue
+
+			if engine:
+				engine.priority = priority
+				engines[service_provider] = await stack.enter_async_context(engine)
+
+		async def fetch(service_provider, shipment_ids):
+			if service_provider not in engines:
+				return {}
+			try:
+				return await engines[service_provider].get_tracking_data_batch(shipment_ids)
+			except Exception as e:
+				return dict.fromkeys(shipment_ids, e)
+
+		shipment_ids = {}
+		for service_provider, shipment_id in shipments.values():
+			shipment_ids.setdefault(service_provider, set()).add(shipment_id)
+
+		batches = await asyncio.gather(
+			*(fetch(service_provider, list(ids)) for service_provider, ids in shipment_ids.items())
+		)
+		tracking_data = dict(zip(shipment_ids, batches))
+
+	results = {}
+	for shipment, (service_provider, shipment_id) in shipments.items():
+		result = tracking_data[service_provider].get(shipment_id)
+		if isinstance(result, circuit_breaker.ProviderUnavailableError):
+			# refused by the open circuit, the next poll tries again
+			result = None
+		elif isinstance(result, BaseException):
+			frappe.log_error(
+				title="Shipping Error",
+				message="".join(traceback.format_exception(result)),
+				reference_doctype="Shipment",
+				reference_name=shipment,
+			)
+			result = None
+		results[shipment] = result
+
+	return results
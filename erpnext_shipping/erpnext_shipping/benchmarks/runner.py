@@ -0,0 +1,341 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+"""Offline microbenchmarks of the shipping hot paths.
+
+Provider calls are answered from the recorded responses in `fixtures`, so no
+credentials or network access are needed. Run them on any site with
+
+	bench --site <site> execute erpnext_shipping.erpnext_shipping.benchmarks.runner.run \
+		--kwargs "{'output': 'shipping-benchmarks.json'}"
+
+and compare two results with `compare`, e.g. the last release against the
+current one:
+
+	bench --site <site> execute erpnext_shipping.erpnext_shipping.benchmarks.runner.compare \
+		--kwargs "{'baseline': 'v14.3.3.json', 'current': 'shipping-benchmarks.json'}"
+"""
+
+import json
+import os
+import platform
+import statistics
+import time
+from contextlib import ExitStack
+from functools import lru_cache
+from unittest.mock import patch
+
+import frappe
+
+import erpnext_shipping
+from erpnext_shipping.erpnext_shipping import http_client
+from erpnext_shipping.erpnext_shipping.doctype.letmeship.letmeship import LetMeShipUtils
+from erpnext_shipping.erpnext_shipping.doctype.parcel_service_type.parcel_service_type import get_index_key
+from erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud import (
+	SendCloudUtils,
+	build_catalog_index,
+	check_weight,
+	get_matching_methods,
+)
+from erpnext_shipping.erpnext_shipping.providers import clear_rate_cache
+from erpnext_shipping.erpnext_shipping.utils import match_parcel_service_type_carrier
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+DEFAULT_ITERATIONS = 1000
+DEFAULT_WARMUP = 50
+# Iterations of the end-to-end quote path, which spawns a thread per provider
+RATE_PATH_ITERATIONS = 50
+# Relative slowdown of the median that `compare` reports as a regression
+DEFAULT_THRESHOLD = 0.1
+
+
+class RecordedResponse:
+	def __init__(self, data: dict):
+		self.text = json.dumps(data)
+		self.status_code = 200
+
+	def json(self):
+		return json.loads(self.text)
+
+
+class RecordedSendCloud(SendCloudUtils):
+	"""SendCloud client that answers from the recorded shipping methods."""
+
+	def __init__(self):
+		self.api_key = "benchmark"
+		self.api_secret = "benchmark"
+		self.enabled = 1
+
+	def get_country_methods(self, to_country: str) -> dict | None:
+		return get_recorded_catalog_index().get(to_country)
+
+
+def run(output: str | None = None, iterations: int = DEFAULT_ITERATIONS) -> dict:
+	"""Run all benchmarks and return the results, optionally writing them to `output` as JSON."""
+	results = {
+		"app_version": erpnext_shipping.__version__,
+		"python": platform.python_version(),
+		"timestamp": time.time(),
+		"unit": "seconds",
+		"benchmarks": {},
+	}
+
+	for name, benchmark, benchmark_iterations in get_benchmarks(iterations):
+		results["benchmarks"][name] = benchmark(benchmark_iterations)
+
+	if output:
+		with open(output, "w") as f:
+			json.dump(results, f, indent=1)
+
+	return results
+
+
+def compare(baseline: str, current: str, threshold: float = DEFAULT_THRESHOLD) -> dict:
+	"""Return {benchmark: relative change of the median} and raise if any of them regressed."""
+	with open(baseline) as f:
+		baseline_results = json.load(f)["benchmarks"]
+	with open(current) as f:
+		current_results = json.load(f)["benchmarks"]
+
+	changes = {
+		name: current_results[name]["median"] / baseline_results[name]["median"] - 1
+		for name in current_results
+		if baseline_results.get(name, {}).get("median")
+	}
+
+	regressions = {name: change for name, change in changes.items() if change > threshold}
+	if regressions:
+		frappe.throw(
+			"Benchmarks slower than {0:.0%}: {1}".format(
+				threshold, ", ".join(f"{name} (+{change:.0%})" for name, change in regressions.items())
+			)
+		)
+
+	return changes
+
+
+def get_benchmarks(iterations: int) -> list[tuple]:
+	return [
+		("letmeship.generate_payload", bench_generate_payload, iterations),
+		("letmeship.get_parcel_list", bench_get_parcel_list, iterations),
+		("letmeship.get_service_dict", bench_get_service_dict, iterations),
+		("sendcloud.check_weight", bench_check_weight, iterations),
+		("sendcloud.get_matching_methods", bench_get_matching_methods, iterations),
+		("sendcloud.get_available_services", bench_sendcloud_available_services, iterations),
+		("utils.match_parcel_service_type_carrier", bench_match_parcel_service_type_carrier, iterations),
+		("shipping.fetch_shipping_rates.cold", bench_fetch_shipping_rates_cold, RATE_PATH_ITERATIONS),
+		("shipping.fetch_shipping_rates.cached", bench_fetch_shipping_rates_cached, iterations),
+	]
+
+
+def bench_generate_payload(iterations: int) -> dict:
+	letmeship = get_letmeship()
+	rate_request = get_rate_request()
+	pickup_contact, delivery_contact = get_contacts()
+	letmeship.set_letmeship_specific_fields(pickup_contact, delivery_contact)
+	parcel_list = letmeship.get_parcel_list(rate_request.parcels, rate_request.description_of_content)
+
+	return measure(
+		lambda: letmeship.generate_payload(
+			pickup_address=rate_request.pickup_address,
+			pickup_contact=pickup_contact,
+			delivery_address=rate_request.delivery_address,
+			delivery_contact=delivery_contact,
+			description_of_content=rate_request.description_of_content,
+			value_of_goods=rate_request.value_of_goods,
+			parcel_list=parcel_list,
+			pickup_date=rate_request.pickup_date,
+		),
+		iterations,
+	)
+
+
+def bench_get_parcel_list(iterations: int) -> dict:
+	letmeship = get_letmeship()
+	rate_request = get_rate_request()
+	return measure(
+		lambda: letmeship.get_parcel_list(rate_request.parcels, rate_request.description_of_content),
+		iterations,
+	)
+
+
+def bench_get_service_dict(iterations: int) -> dict:
+	letmeship = get_letmeship()
+	service_list = load_fixture("letmeship_available")["serviceList"]
+	return measure(lambda: [letmeship.get_service_dict(service) for service in service_list], iterations)
+
+
+def bench_check_weight(iterations: int) -> dict:
+	shipping_methods = load_fixture("sendcloud_shipping_methods")["shipping_methods"]
+	parcels = get_rate_request().parcels
+	return measure(lambda: [check_weight(service, parcels) for service in shipping_methods], iterations)
+
+
+def bench_get_matching_methods(iterations: int) -> dict:
+	rate_request = get_rate_request()
+	country_methods = get_recorded_catalog_index()[rate_request.delivery_address.country_code]
+	return measure(lambda: get_matching_methods(country_methods, rate_request.parcels), iterations)
+
+
+def bench_sendcloud_available_services(iterations: int) -> dict:
+	sendcloud = RecordedSendCloud()
+	rate_request = get_rate_request()
+	return measure(
+		lambda: sendcloud.get_available_services(rate_request.delivery_address, rate_request.parcels),
+		iterations,
+	)
+
+
+def bench_match_parcel_service_type_carrier(iterations: int) -> dict:
+	rate_request = get_rate_request()
+	prices = RecordedSendCloud().get_available_services(rate_request.delivery_address, rate_request.parcels)
+	letmeship = get_letmeship()
+	prices += [
+		letmeship.get_service_dict(service) for service in load_fixture("letmeship_available")["serviceList"]
+	]
+
+	with patch(
+		"erpnext_shipping.erpnext_shipping.doctype.parcel_service_type.parcel_service_type.get_parcel_service_type_index",
+		return_value=get_parcel_service_type_index(prices),
+	):
+		return measure(
+			lambda: match_parcel_service_type_carrier(prices, "carrier", "service_name"), iterations
+		)
+
+
+def bench_fetch_shipping_rates_cold(iterations: int) -> dict:
+	with recorded_providers():
+		return measure(call_fetch_shipping_rates, iterations, setup=clear_rate_cache, warmup=1)
+
+
+def bench_fetch_shipping_rates_cached(iterations: int) -> dict:
+	with recorded_providers():
+		call_fetch_shipping_rates()
+		result = measure(call_fetch_shipping_rates, iterations)
+		clear_rate_cache()
+		return result
+
+
+def call_fetch_shipping_rates():
+	from erpnext_shipping.erpnext_shipping.shipping import fetch_shipping_rates
+
+	fixture = load_fixture("rate_request")
+	return fetch_shipping_rates(
+		pickup_from_type=fixture["pickup_from_type"],
+		delivery_to_type=fixture["delivery_to_type"],
+		pickup_address_name=fixture["pickup_address_name"],
+		delivery_address_name=fixture["delivery_address_name"],
+		parcels=json.dumps(fixture["parcels"]),
+		description_of_content=fixture["description_of_content"],
+		pickup_date=fixture["pickup_date"],
+		value_of_goods=fixture["value_of_goods"],
+	)
+
+
+def recorded_providers() -> ExitStack:
+	"""Patch the quote path so that both providers answer from the fixtures."""
+	from erpnext_shipping.erpnext_shipping.doctype.letmeship.letmeship import get_letmeship_rates
+	from erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud import get_sendcloud_rates
+
+	addresses = load_fixture("rate_request")["addresses"]
+	stack = ExitStack()
+	for target, kwargs in {
+		"erpnext_shipping.erpnext_shipping.providers.get_enabled_rate_providers": {
+			"return_value": {"LetMeShip": get_letmeship_rates, "SendCloud": get_sendcloud_rates}
+		},
+		"erpnext_shipping.erpnext_shipping.shipping.get_address": {
+			"side_effect": lambda name: frappe._dict(addresses[name])
+		},
+		"erpnext_shipping.erpnext_shipping.utils.get_shipment_contacts": {"side_effect": get_contacts_for},
+		"erpnext_shipping.erpnext_shipping.doctype.letmeship.letmeship.get_letmeship_utils": {
+			"side_effect": get_letmeship
+		},
+		"erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud.SendCloudUtils": {
+			"new": RecordedSendCloud
+		},
+	}.items():
+		stack.enter_context(patch(target, **kwargs))
+
+	stack.enter_context(
+		patch.object(
+			http_client,
+			"post",
+			side_effect=lambda *args, **kwargs: RecordedResponse(load_fixture("letmeship_available")),
+		)
+	)
+	return stack
+
+
+def measure(func, iterations: int, setup=None, warmup: int = DEFAULT_WARMUP) -> dict:
+	"""Time `func` per call, running `setup` untimed before every call."""
+	for _i in range(warmup):
+		if setup:
+			setup()
+		func()
+
+	timings = []
+	for _i in range(iterations):
+		if setup:
+			setup()
+		start = time.perf_counter()
+		func()
+		timings.append(time.perf_counter() - start)
+
+	timings.sort()
+	return {
+		"iterations": iterations,
+		"min": timings[0],
+		"median": statistics.median(timings),
+		"mean": statistics.fmean(timings),
+		"p95": timings[min(int(iterations * 0.95), iterations - 1)],
+		"stdev": statistics.stdev(timings) if iterations > 1 else 0,
+	}
+
+
+@lru_cache
+def load_fixture(name: str) -> dict:
+	"""Return a recorded fixture. It is shared between calls and must not be modified."""
+	with open(os.path.join(FIXTURES_DIR, f"{name}.json")) as f:
+		return json.load(f)
+
+
+@lru_cache
+def get_recorded_catalog_index() -> dict:
+	return build_catalog_index(load_fixture("sendcloud_shipping_methods")["shipping_methods"])
+
+
+def get_rate_request() -> frappe._dict:
+	fixture = load_fixture("rate_request")
+	return frappe._dict(
+		pickup_from_type=fixture["pickup_from_type"],
+		delivery_to_type=fixture["delivery_to_type"],
+		pickup_address=frappe._dict(fixture["addresses"][fixture["pickup_address_name"]]),
+		delivery_address=frappe._dict(fixture["addresses"][fixture["delivery_address_name"]]),
+		parcels=fixture["parcels"],
+		description_of_content=fixture["description_of_content"],
+		pickup_date=fixture["pickup_date"],
+		value_of_goods=fixture["value_of_goods"],
+	)
+
+
+def get_contacts() -> tuple:
+	fixture = load_fixture("rate_request")
+	return frappe._dict(fixture["pickup_contact"]), frappe._dict(fixture["delivery_contact"])
+
+
+def get_contacts_for(*args) -> tuple:
+	return get_contacts()
+
+
+def get_letmeship(*args) -> LetMeShipUtils:
+	return LetMeShipUtils(
+		base_url="https://letmeship.invalid/v1", api_id="benchmark", api_password="benchmark"
+	)
+
+
+def get_parcel_service_type_index(prices: list[dict]) -> dict:
+	"""Return an index that knows every other quoted service, half of those as preferred."""
+	return {
+		get_index_key(price.carrier, price.service_name): (price.service_name, idx % 4 == 0)
+		for idx, price in enumerate(prices)
+		if idx % 2 == 0
+	}
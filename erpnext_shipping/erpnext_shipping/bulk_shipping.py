@@ -0,0 +1,408 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+import json
+import os
+import tempfile
+
+import frappe
+from frappe import _
+from frappe.utils import now_datetime
+
+from erpnext_shipping.erpnext_shipping.concurrency import SiteThreadPoolExecutor
+from erpnext_shipping.erpnext_shipping.doctype.letmeship.letmeship import (
+	LETMESHIP_PROVIDER,
+	get_letmeship_utils,
+)
+from erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud import SENDCLOUD_PROVIDER, SendCloudUtils
+from erpnext_shipping.erpnext_shipping.providers import clear_rate_cache
+from erpnext_shipping.erpnext_shipping.shipping import (
+	create_shipment,
+	get_delivery_company_name,
+	update_booked_shipment,
+)
+from erpnext_shipping.erpnext_shipping.utils import get_address, get_shipment_contacts, merge_pdfs
+
+# Selections up to this size are booked within the request, larger ones in a background job.
+BULK_JOB_THRESHOLD = 20
+# Parcels sent to SendCloud per request, override with `sendcloud_parcel_batch_size` in site config.
+DEFAULT_SENDCLOUD_BATCH_SIZE = 100
+LETMESHIP_BOOKING_WORKERS = 8
+LABEL_WORKERS = 8
+
+
+@frappe.whitelist()
+def create_shipments(shipments):
+	"""Book many Shipments at once.
+
+	`shipments` is a list of {"shipment": name, "service_data": selected rate}.
+	Returns one result per Shipment, or, for large selections, enqueues the
+	booking and publishes the results with the `shipping_bulk_booking` realtime event.
+	"""
+	frappe.has_permission("Shipment", "write", throw=True)
+	shipments = get_unique_rows(frappe.parse_json(shipments))
+
+	if len(shipments) <= BULK_JOB_THRESHOLD:
+		return book_shipments(shipments)
+
+	frappe.enqueue(
+		"erpnext_shipping.erpnext_shipping.bulk_shipping.book_shipments",
+		queue="long",
+		timeout=60 * 60,
+		shipments=shipments,
+		notify_user=frappe.session.user,
+	)
+	frappe.msgprint(_("Booking {0} Shipments in the background.").format(len(shipments)), alert=True)
+
+
+def book_shipments(shipments: list[dict], notify_user: str | None = None) -> list[dict]:
+	"""Book Shipments grouped by provider and return one result per Shipment, in order.
+
+	Every Shipment is booked at most once, and only if the user may write it.
+	"""
+	shipments = get_unique_rows(shipments)
+	results = {}
+	bookings = {}
+	for row in shipments:
+		shipment = row["shipment"]
+		service_info = frappe.parse_json(row["service_data"])
+		try:
+			shipment_doc = frappe.get_doc("Shipment", shipment)
+		except frappe.DoesNotExistError:
+			frappe.clear_last_message()
+			results[shipment] = get_result(shipment, error=_("Shipment {0} not found.").format(shipment))
+			continue
+
+		try:
+			shipment_doc.check_permission("write")
+		except frappe.PermissionError:
+			frappe.clear_last_message()
+			results[shipment] = get_result(shipment, error=_("Not permitted to book this Shipment."))
+			continue
+
+		if shipment_doc.docstatus != 1 or shipment_doc.shipment_id:
+			results[shipment] = get_result(shipment, error=_("Shipment is not submitted or already booked."))
+		elif service_info.get("service_provider") not in (LETMESHIP_PROVIDER, SENDCLOUD_PROVIDER):
+			results[shipment] = get_result(shipment, error=_("Unknown service provider."))
+		else:
+			bookings.setdefault(service_info["service_provider"], []).append(
+				get_booking_args(shipment_doc, service_info)
+			)
+
+	if SENDCLOUD_PROVIDER in bookings:
+		results.update(book_sendcloud_shipments(bookings[SENDCLOUD_PROVIDER]))
+	if LETMESHIP_PROVIDER in bookings:
+		results.update(book_letmeship_shipments(bookings[LETMESHIP_PROVIDER]))
+
+	results = [results[row["shipment"]] for row in shipments]
+	if notify_user:
+		frappe.publish_realtime("shipping_bulk_booking", results, user=notify_user, after_commit=True)
+
+	return results
+
+
+def get_unique_rows(shipments: list[dict]) -> list[dict]:
+	"""Return the rows without repeated Shipments, so that none is booked twice."""
+	seen = set()
+	unique_rows = []
+	for row in shipments:
+		if row["shipment"] not in seen:
+			seen.add(row["shipment"])
+			unique_rows.append(row)
+
+	return unique_rows
+
+
+def get_booking_args(shipment_doc, service_info: dict) -> dict:
+	"""Return the arguments of `create_shipment` for a Shipment and the selected service."""
+	return {
+		"shipment": shipment_doc.name,
+		"pickup_from_type": shipment_doc.pickup_from_type,
+		"delivery_to_type": shipment_doc.delivery_to_type,
+		"pickup_address_name": shipment_doc.pickup_address_name,
+		"delivery_address_name": shipment_doc.delivery_address_name,
+		"shipment_parcel": frappe.as_json([row.as_dict() for row in shipment_doc.shipment_parcel]),
+		"description_of_content": shipment_doc.description_of_content,
+		"pickup_date": str(shipment_doc.pickup_date),
+		"value_of_goods": shipment_doc.value_of_goods,
+		"service_data": json.dumps(service_info),
+		"pickup_contact_name": shipment_doc.pickup_contact_person
+		if shipment_doc.pickup_from_type == "Company"
+		else shipment_doc.pickup_contact_name,
+		"delivery_contact_name": shipment_doc.delivery_contact_name,
+		"delivery_notes": [row.delivery_note for row in shipment_doc.shipment_delivery_note],
+	}
+
+
+def book_letmeship_shipments(bookings: list[dict]) -> dict:
+	"""LetMeShip books one Shipment per request, so these requests run concurrently."""
+	with SiteThreadPoolExecutor(max_workers=min(len(bookings), LETMESHIP_BOOKING_WORKERS)) as executor:
+		return {result["shipment"]: result for result in executor.map(book_letmeship_shipment, bookings)}
+
+
+def book_letmeship_shipment(booking_args: dict) -> dict:
+	try:
+		shipment_info = create_shipment(**booking_args)
+	except Exception:
+		frappe.log_error(
+			title="Shipping Error", reference_doctype="Shipment", reference_name=booking_args["shipment"]
+		)
+		shipment_info = None
+
+	if not shipment_info:
+		return get_result(booking_args["shipment"], error=get_last_message() or _("Booking failed."))
+
+	return get_result(booking_args["shipment"], shipment_info=shipment_info)
+
+
+def book_sendcloud_shipments(bookings: list[dict]) -> dict:
+	"""Send the parcels of many Shipments to SendCloud with as few requests as possible.
+
+	The parcels of one Shipment always go into the same request.
+	"""
+	sendcloud = SendCloudUtils()
+	batch_size = frappe.conf.get("sendcloud_parcel_batch_size") or DEFAULT_SENDCLOUD_BATCH_SIZE
+	results = {}
+	batch, batch_parcels = [], []
+
+	for booking_args in bookings:
+		service_info = json.loads(booking_args["service_data"])
+		try:
+			parcels = get_sendcloud_parcels(sendcloud, booking_args, service_info)
+		except Exception:
+			results[booking_args["shipment"]] = get_result(
+				booking_args["shipment"], error=get_last_message() or _("Booking failed.")
+			)
+			continue
+
+		batch.append((booking_args, service_info))
+		batch_parcels.extend(parcels)
+		if len(batch_parcels) >= batch_size:
+			results.update(create_sendcloud_batch(sendcloud, batch, batch_parcels))
+			batch, batch_parcels = [], []
+
+	if batch:
+		results.update(create_sendcloud_batch(sendcloud, batch, batch_parcels))
+
+	return results
+
+
+def get_sendcloud_parcels(sendcloud, booking_args: dict, service_info: dict) -> list[dict]:
+	_pickup_contact, delivery_contact = get_shipment_contacts(
+		booking_args["pickup_from_type"],
+		booking_args["delivery_to_type"],
+		booking_args["pickup_contact_name"],
+		booking_args["delivery_contact_name"],
+	)
+	return sendcloud.get_shipment_parcels(
+		shipment=booking_args["shipment"],
+		delivery_company_name=get_delivery_company_name(booking_args["shipment"]),
+		delivery_address=get_address(booking_args["delivery_address_name"]),
+		delivery_contact=delivery_contact,
+		service_info=service_info,
+		shipment_parcel=booking_args["shipment_parcel"],
+		description_of_content=booking_args["description_of_content"],
+		value_of_goods=booking_args["value_of_goods"],
+	)
+
+
+def create_sendcloud_batch(sendcloud, batch: list[tuple], parcels: list[dict]) -> dict:
+	try:
+		response_data = sendcloud.create_parcels(parcels)
+	except Exception:
+		frappe.log_error(title="Shipping Error")
+		return {
+			booking_args["shipment"]: get_result(
+				booking_args["shipment"], error=_("SendCloud request failed.")
+			)
+			for booking_args, _service_info in batch
+		}
+
+	# parcels are referenced as "{shipment}-{index}", see SendCloudUtils.get_parcel_dict
+	created_parcels, errors = {}, {}
+	for parcel in response_data.get("parcels", []):
+		created_parcels.setdefault(parcel["external_reference"].rsplit("-", 1)[0], []).append(parcel)
+	for failed_parcel in response_data.get("failed_parcels", []):
+		reference = failed_parcel["parcel"]["external_reference"].rsplit("-", 1)[0]
+		errors.setdefault(reference, failed_parcel["errors"])
+
+	results = {}
+	for booking_args, service_info in batch:
+		shipment = booking_args["shipment"]
+		if shipment in errors or shipment not in created_parcels:
+			message = _("Error occurred while creating Shipment: {0}").format(errors.get(shipment))
+			if shipment in created_parcels:
+				parcel_ids = ", ".join(str(parcel["id"]) for parcel in created_parcels[shipment])
+				message += " " + _("Parcels {0} were created at SendCloud nevertheless.").format(parcel_ids)
+			results[shipment] = get_result(shipment, error=message)
+			continue
+
+		parcels = sorted(
+			created_parcels[shipment], key=lambda p: int(p["external_reference"].rsplit("-", 1)[1])
+		)
+		shipment_info = sendcloud.get_shipment_info(parcels, service_info)
+		update_booked_shipment(shipment, shipment_info, booking_args["delivery_notes"])
+		clear_rate_cache(
+			frappe._dict(
+				pickup_from_type=booking_args["pickup_from_type"],
+				pickup_address=get_address(booking_args["pickup_address_name"]),
+				delivery_address=get_address(booking_args["delivery_address_name"]),
+				parcels=json.loads(booking_args["shipment_parcel"]),
+				value_of_goods=booking_args["value_of_goods"],
+				pickup_date=booking_args["pickup_date"],
+			)
+		)
+		results[shipment] = get_result(shipment, shipment_info=shipment_info)
+
+	# the parcels exist at SendCloud now, keep their ids even if a later batch fails
+	frappe.db.commit()
+	return results
+
+
+def get_result(shipment: str, shipment_info: dict | None = None, error: str | None = None) -> dict:
+	return {
+		"shipment": shipment,
+		"status": "Booked" if shipment_info else "Failed",
+		"shipment_id": shipment_info.get("shipment_id") if shipment_info else None,
+		"service_provider": shipment_info.get("service_provider") if shipment_info else None,
+		"error": error,
+	}
+
+
+def get_last_message() -> str | None:
+	"""Return the last message logged in this context, e.g. the reason a booking failed."""
+	if not frappe.local.message_log:
+		return None
+
+	message = frappe.local.message_log[-1]
+	if isinstance(message, str):  # Frappe v14 stores messages as JSON
+		message = json.loads(message)
+
+	return message.get("message")
+
+
+@frappe.whitelist()
+def print_shipping_labels(shipments):
+	"""Return the URL of one PDF with the labels of all `shipments`, in the given order.
+
+	Large selections are built in the background, the URL is then published with
+	the `shipping_labels_ready` realtime event.
+	"""
+	frappe.has_permission("Shipment", "print", throw=True)
+	shipments = frappe.parse_json(shipments)
+
+	if len(shipments) <= BULK_JOB_THRESHOLD:
+		return build_shipping_labels(shipments)
+
+	frappe.enqueue(
+		"erpnext_shipping.erpnext_shipping.bulk_shipping.build_shipping_labels",
+		queue="long",
+		timeout=60 * 60,
+		shipments=shipments,
+		notify_user=frappe.session.user,
+	)
+	frappe.msgprint(
+		_("Collecting the labels of {0} Shipments in the background.").format(len(shipments)), alert=True
+	)
+
+
+def build_shipping_labels(shipments: list[str], notify_user: str | None = None) -> str | None:
+	"""Fetch the labels of all parcels of all Shipments in parallel and merge them into one File.
+
+	Shipments the user may not print are left out like those without a label.
+	"""
+	booked_shipments = {
+		shipment.name: shipment
+		for shipment in frappe.get_all(
+			"Shipment",
+			filters={"name": ["in", shipments], "docstatus": 1, "shipment_id": ["is", "set"]},
+			fields=["name", "service_provider", "shipment_id"],
+		)
+		# the DocType level check doesn't cover user permissions on single Shipments
+		if frappe.has_permission("Shipment", "print", doc=shipment.name)
+	}
+	service_providers = {shipment.service_provider for shipment in booked_shipments.values()}
+	provider_utils = {}
+	if LETMESHIP_PROVIDER in service_providers:
+		provider_utils[LETMESHIP_PROVIDER] = get_letmeship_utils()
+	if SENDCLOUD_PROVIDER in service_providers:
+		provider_utils[SENDCLOUD_PROVIDER] = SendCloudUtils()
+
+	# one (shipment, provider, label id) per label, in print order
+	labels = []
+	for shipment in shipments:
+		shipment_doc = booked_shipments.get(shipment)
+		if not shipment_doc or shipment_doc.service_provider not in provider_utils:
+			continue
+		if shipment_doc.service_provider == LETMESHIP_PROVIDER:
+			labels.append((shipment, LETMESHIP_PROVIDER, shipment_doc.shipment_id))
+		else:
+			labels.extend(
+				(shipment, SENDCLOUD_PROVIDER, parcel_id)
+				for parcel_id in shipment_doc.shipment_id.split(", ")
+			)
+
+	file_url = None
+	missing = [shipment for shipment in shipments if shipment not in {label[0] for label in labels}]
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		label_paths = [os.path.join(tmp_dir, f"label_{idx}.pdf") for idx in range(len(labels))]
+		with SiteThreadPoolExecutor(max_workers=max(min(len(labels), LABEL_WORKERS), 1)) as executor:
+			fetched = list(
+				executor.map(
+					fetch_label,
+					[provider_utils[provider] for _shipment, provider, _label_id in labels],
+					[label_id for _shipment, _provider, label_id in labels],
+					label_paths,
+				)
+			)
+
+		for (shipment, _provider, _label_id), ok in zip(labels, fetched):
+			if not ok and shipment not in missing:
+				missing.append(shipment)
+
+		label_paths = [path for path, ok in zip(label_paths, fetched) if ok]
+		if label_paths:
+			file_url = save_shipping_labels(merge_pdfs(label_paths))
+
+	if missing:
+		frappe.msgprint(
+			_("No label could be printed for the following Shipments: {0}").format(", ".join(missing)),
+			title=_("Label Not Found"),
+		)
+
+	if notify_user:
+		frappe.publish_realtime(
+			"shipping_labels_ready",
+			{"file_url": file_url, "missing": missing},
+			user=notify_user,
+			after_commit=True,
+		)
+
+	return file_url
+
+
+def fetch_label(provider_utils, label_id: str, path: str) -> bool:
+	"""Write the label with `label_id` to `path`, return whether that worked."""
+	try:
+		if isinstance(provider_utils, SendCloudUtils):
+			provider_utils.download_label_to_file(provider_utils.get_label_url(label_id), path)
+		else:
+			label = provider_utils.get_label(label_id)
+			if not label:
+				return False
+			with open(path, "wb") as f:
+				f.write(label)
+		return True
+	except Exception:
+		frappe.log_error(title="Shipping Error")
+		return False
+
+
+def save_shipping_labels(content: bytes) -> str:
+	attachment = frappe.new_doc("File")
+	attachment.file_name = f"shipping_labels_{now_datetime():%Y%m%d_%H%M%S}.pdf"
+	attachment.content = content
+	attachment.folder = "Home/Attachments"
+	attachment.is_private = 1
+	attachment.save()
+
+	return attachment.file_url
@@ -0,0 +1,100 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+"""A circuit breaker per provider, shared by all workers through Redis.
+
+After `shipping_circuit_failure_threshold` failed calls within a minute the
+circuit opens and calls to the provider fail right away. Once
+`shipping_circuit_open_seconds` have passed, a single call is let through as a
+probe: if it succeeds the circuit closes, if it fails it opens again.
+"""
+
+import time
+
+import frappe
+from frappe import _
+
+CIRCUIT_KEY = "shipping_circuit"
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_OPEN_SECONDS = 30
+# Failures older than this no longer count towards the threshold
+FAILURE_WINDOW = 60
+
+
+class ProviderUnavailableError(frappe.ValidationError):
+	pass
+
+
+def check_circuit(provider: str):
+	"""Raise `ProviderUnavailableError` if calls to the provider should not be sent."""
+	if not is_available(provider):
+		frappe.throw(
+			_("{0} is currently unavailable, please try again later.").format(provider),
+			ProviderUnavailableError,
+			title=_("Provider Unavailable"),
+		)
+
+
+def is_available(provider: str) -> bool:
+	"""Return True if a call may be sent. Claims the probe if the circuit is half open."""
+	open_until = get_open_until(provider)
+	if not open_until:
+		return True
+
+	if open_until > time.time():
+		return False
+
+	cache = frappe.cache()
+	return bool(cache.set(get_key(provider, "probe"), 1, nx=True, ex=get_open_seconds()))
+
+
+def is_open(provider: str) -> bool:
+	"""Return True while the circuit is open and no probe is due yet."""
+	return get_open_until(provider) > time.time()
+
+
+def record_success(provider: str):
+	try:
+		cache = frappe.cache()
+		cache.delete(
+			get_key(provider, "failures"), get_key(provider, "open_until"), get_key(provider, "probe")
+		)
+	except Exception:
+		pass
+
+
+def record_failure(provider: str):
+	try:
+		cache = frappe.cache()
+		failures_key = get_key(provider, "failures")
+		failures = cache.incr(failures_key)
+		if failures == 1:
+			cache.expire(failures_key, FAILURE_WINDOW)
+
+		# raw `get`, `RedisWrapper.exists` would add the site prefix a second time
+		is_probe = cache.get(get_key(provider, "probe")) is not None
+		if is_probe or failures >= get_failure_threshold():
+			open_seconds = get_open_seconds()
+			cache.set(get_key(provider, "open_until"), time.time() + open_seconds, ex=open_seconds * 10)
+			cache.delete(failures_key, get_key(provider, "probe"))
+	except Exception:
+		frappe.log_error(title="Shipping Circuit Breaker Error")
+
+
+def get_open_until(provider: str) -> float:
+	try:
+		return float(frappe.cache().get(get_key(provider, "open_until")) or 0)
+	except Exception:
+		# without Redis, providers are always called
+		return 0
+
+
+def get_key(provider: str, name: str) -> str:
+	return frappe.cache().make_key(f"{CIRCUIT_KEY}::{provider}::{name}")
+
+
+def get_failure_threshold() -> int:
+	return frappe.conf.get("shipping_circuit_failure_threshold") or DEFAULT_FAILURE_THRESHOLD
+
+
+def get_open_seconds() -> int:
+	return frappe.conf.get("shipping_circuit_open_seconds") or DEFAULT_OPEN_SECONDS
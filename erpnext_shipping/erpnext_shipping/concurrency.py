@@ -0,0 +1,91 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+
+
+class SiteThreadPoolExecutor(ThreadPoolExecutor):
+	"""Thread pool whose tasks run inside the caller's site, user and language.
+
+	`frappe.local` is not shared with new threads, so every worker thread sets
+	up its own site context and database connection once, and reuses it for all
+	of its tasks. Each task is committed or rolled back on its own. Messages
+	logged by a task (e.g. via `show_error_alert`) are handed back to the caller
+	on `shutdown`.
+	"""
+
+	def __init__(self, max_workers=None):
+		self.site = frappe.local.site
+		self.sites_path = frappe.local.sites_path
+		self.user = frappe.session.user
+		self.lang = frappe.local.lang
+		self._message_log = []
+		# database connection of each worker thread, by thread id
+		self._connections = {}
+		# worker threads that are running a task
+		self._busy = set()
+		self._lock = threading.Lock()
+		super().__init__(
+			max_workers=max_workers,
+			thread_name_prefix="erpnext_shipping",
+			initializer=self._init_site_context,
+		)
+
+	def submit(self, fn, /, *args, **kwargs):
+		return super().submit(self._run_in_site_context, fn, *args, **kwargs)
+
+	def shutdown(self, wait=True, *, cancel_futures=False):
+		super().shutdown(wait=wait, cancel_futures=cancel_futures)
+		# Close the connections of all threads that are not running a task. With
+		# `wait=True` that is all of them. Threads that are still running close
+		# their own connection when their task finishes.
+		with self._lock:
+			idle = [ident for ident in self._connections if ident not in self._busy]
+			connections = [self._connections.pop(ident) for ident in idle]
+		for db in connections:
+			db.close()
+		self.merge_message_log()
+
+	def merge_message_log(self):
+		"""Move messages collected from finished tasks to the caller's message log."""
+		with self._lock:
+			messages, self._message_log = self._message_log, []
+		frappe.local.message_log.extend(messages)
+
+	def _init_site_context(self):
+		frappe.init(site=self.site, sites_path=self.sites_path)
+		frappe.connect(set_admin_as_user=False)
+		frappe.set_user(self.user)
+		frappe.local.lang = self.lang
+		with self._lock:
+			self._connections[threading.get_ident()] = frappe.local.db
+
+	def _run_in_site_context(self, fn, *args, **kwargs):
+		ident = threading.get_ident()
+		with self._lock:
+			self._busy.add(ident)
+			has_connection = ident in self._connections
+		if not has_connection:
+			# `shutdown` closed the connection while the thread was idle, but
+			# `cancel_futures=False` lets it pick up the tasks still queued
+			self._init_site_context()
+
+		frappe.local.message_log = []
+		try:
+			result = fn(*args, **kwargs)
+			frappe.db.commit()
+			return result
+		except Exception:
+			frappe.db.rollback()
+			raise
+		finally:
+			with self._lock:
+				self._message_log.extend(frappe.local.message_log)
+				self._busy.discard(ident)
+				# `shutdown` has already passed this thread by, close its connection now
+				owns_connection = self._shutdown and self._connections.pop(ident, None) is not None
+			frappe.local.message_log = []
+			if owns_connection:
+				frappe.destroy()
@@ -1,15 +1,17 @@
 # Copyright (c) 2020, Frappe Technologies and contributors
 # For license information, please see license.txt
 
+import base64
 import json
-import re
 
 import frappe
-import requests
 from frappe import _
 from frappe.model.document import Document
 from frappe.utils.data import get_link_to_form
-from erpnext_shipping.erpnext_shipping.utils import show_error_alert
+from erpnext_shipping.erpnext_shipping import http_client
+from erpnext_shipping.erpnext_shipping.async_client import AsyncProvider, call_sync
+from erpnext_shipping.erpnext_shipping.providers import clear_rate_cache
+from erpnext_shipping.erpnext_shipping.utils import parse_phone, show_error_alert
 
 LETMESHIP_PROVIDER = "LetMeShip"
 PROD_BASE_URL = "https://api.letmeship.com/v1"
@@ -17,7 +19,8 @@ TEST_BASE_URL = "https://api.test.letmeship.com/v1"
 
 
 class LetMeShip(Document):
-	pass
+	def on_update(self):
+		clear_rate_cache()
 
 
 class LetMeShipUtils:
@@ -37,6 +40,7 @@ class LetMeShipUtils:
 		value_of_goods,
 		pickup_contact=None,
 		delivery_contact=None,
+		raise_exception=False,
 	):
 		self.set_letmeship_specific_fields(pickup_contact, delivery_contact)
 		pickup_address.address_title = self.first_30_chars(pickup_address.address_title)
@@ -60,8 +64,14 @@ class LetMeShipUtils:
 			pickup_date=pickup_date,
 		)
 		try:
-			response_data = requests.post(
-				url=url, auth=(self.api_id, self.api_password), headers=headers, data=json.dumps(payload)
+			response_data = http_client.post(
+				LETMESHIP_PROVIDER,
+				url,
+				auth=(self.api_id, self.api_password),
+				headers=headers,
+				data=json.dumps(payload),
+				idempotent=True,
+				endpoint="available",
 			)
 			response_data = json.loads(response_data.text)
 			if "status" in response_data and response_data["status"]["code"] != "0":
@@ -78,6 +88,8 @@ class LetMeShipUtils:
 
 				return available_services
 		except Exception:
+			if raise_exception:
+				raise
 			show_error_alert("fetching LetMeShip prices")
 
 		return []
@@ -120,8 +132,13 @@ class LetMeShipUtils:
 			service_info=service_info,
 		)
 		try:
-			response_data = requests.post(
-				url=url, auth=(self.api_id, self.api_password), headers=headers, data=json.dumps(payload)
+			response_data = http_client.post(
+				LETMESHIP_PROVIDER,
+				url,
+				auth=(self.api_id, self.api_password),
+				headers=headers,
+				data=json.dumps(payload),
+				endpoint="shipments",
 			)
 			response_data = json.loads(response_data.text)
 			if response_data["status"]["code"] != "0":
@@ -132,15 +149,9 @@ class LetMeShipUtils:
 				)
 			else:
 				shipment_amount = response_data["service"]["priceInfo"]["totalPrice"]
-				awb_number = ""
 				shipment_id = response_data["shipmentId"]
-				url = f"{self.base_url}/shipments/{shipment_id}"
-				tracking_response = requests.get(url, auth=(self.api_id, self.api_password), headers=headers)
-				tracking_response_data = json.loads(tracking_response.text)
-				if "trackingData" in tracking_response_data:
-					for parcel in tracking_response_data["trackingData"]["parcelList"]:
-						if "awbNumber" in parcel:
-							awb_number = parcel["awbNumber"]
+				# the carrier assigns the AWB number later, see `tracking.schedule_awb_lookup`
+				awb_number = ""
 				return {
 					"service_provider": LETMESHIP_PROVIDER,
 					"shipment_id": shipment_id,
@@ -152,8 +163,8 @@ class LetMeShipUtils:
 		except Exception:
 			show_error_alert("creating LetMeShip Shipment")
 
-	def get_label(self, shipment_id):
-		# Retrieve shipment label from LetMeShip
+	def get_label(self, shipment_id) -> bytes | None:
+		# Retrieve shipment label PDF from LetMeShip
 		try:
 			headers = {
 				"Content-Type": "application/json",
@@ -161,14 +172,18 @@ class LetMeShipUtils:
 				"Access-Control-Allow-Origin": "string",
 			}
 			url = f"{self.base_url}/shipments/{shipment_id}/documents?types=LABEL"
-			shipment_label_response = requests.get(
-				url, auth=(self.api_id, self.api_password), headers=headers
+			shipment_label_response = http_client.get(
+				LETMESHIP_PROVIDER,
+				url,
+				auth=(self.api_id, self.api_password),
+				headers=headers,
+				endpoint="labels",
 			)
 			shipment_label_response_data = json.loads(shipment_label_response.text)
 			if "documents" in shipment_label_response_data:
 				for label in shipment_label_response_data["documents"]:
 					if "data" in label:
-						return json.dumps(label["data"])
+						return get_label_content(label["data"])
 			else:
 				frappe.throw(
 					_("Error occurred while printing Shipment: {0}").format(
@@ -179,39 +194,10 @@ class LetMeShipUtils:
 			show_error_alert("printing LetMeShip Label")
 
 	def get_tracking_data(self, shipment_id):
-		from erpnext_shipping.erpnext_shipping.utils import get_tracking_url
-
 		# return letmeship tracking data
-		headers = {
-			"Content-Type": "application/json",
-			"Accept": "application/json",
-			"Access-Control-Allow-Origin": "string",
-		}
 		try:
-			url = f"{self.base_url}/tracking?shipmentid={shipment_id}"
-			tracking_data_response = requests.get(url, auth=(self.api_id, self.api_password), headers=headers)
-			tracking_data = json.loads(tracking_data_response.text)
-			if "awbNumber" in tracking_data:
-				tracking_status = "In Progress"
-				if tracking_data["lmsTrackingStatus"].startswith("DELIVERED"):
-					tracking_status = "Delivered"
-				if tracking_data["lmsTrackingStatus"] == "RETURNED":
-					tracking_status = "Returned"
-				if tracking_data["lmsTrackingStatus"] == "LOST":
-					tracking_status = "Lost"
-				tracking_url = get_tracking_url(
-					carrier=tracking_data["carrier"], tracking_number=tracking_data["awbNumber"]
-				)
-				return {
-					"awb_number": tracking_data["awbNumber"],
-					"tracking_status": tracking_status,
-					"tracking_status_info": tracking_data["lmsTrackingStatus"],
-					"tracking_url": tracking_url,
-				}
-			elif "message" in tracking_data:
-				frappe.throw(
-					_("Error occurred while updating Shipment: {0}").format(tracking_data["message"])
-				)
+			engine = AsyncLetMeShip(self.base_url, self.api_id, self.api_password)
+			return call_sync(engine, "get_tracking_data", shipment_id)
 		except Exception:
 			show_error_alert("updating LetMeShip Shipment")
 
@@ -294,19 +280,14 @@ class LetMeShipUtils:
 		return available_service
 
 	def set_letmeship_specific_fields(self, pickup_contact, delivery_contact):
-		pickup_contact.phone_prefix = pickup_contact.phone[:3]
-		pickup_contact.phone = re.sub("[^A-Za-z0-9]+", "", pickup_contact.phone[3:])
-
-		pickup_contact.title = "MS"
-		if pickup_contact.gender == "Male":
-			pickup_contact.title = "MR"
-
-		delivery_contact.phone_prefix = delivery_contact.phone[:3]
-		delivery_contact.phone = re.sub("[^A-Za-z0-9]+", "", delivery_contact.phone[3:])
+		for contact in (pickup_contact, delivery_contact):
+			if "phone_number" not in contact:
+				contact.phone_prefix, contact.phone_number = parse_phone(contact.phone)
+			contact.phone = contact.phone_number
 
-		delivery_contact.title = "MS"
-		if delivery_contact.gender == "Male":
-			delivery_contact.title = "MR"
+			contact.title = "MS"
+			if contact.gender == "Male":
+				contact.title = "MR"
 
 	def get_parcel_list(self, parcels, description_of_content):
 		parcel_list = []
@@ -342,14 +323,102 @@ class LetMeShipUtils:
 		}
 
 
-def get_letmeship_utils() -> "LetMeShipUtils":
+class AsyncLetMeShip(AsyncProvider):
+	name = LETMESHIP_PROVIDER
+
+	def __init__(self, base_url: str, api_id: str, api_password: str):
+		self.base_url = base_url
+		self.api_password = api_password
+		self.api_id = api_id
+
+	def get_auth(self):
+		return (self.api_id, self.api_password)
+
+	async def get_tracking_data(self, shipment_id):
+		response = await self.client.get(
+			f"{self.base_url}/tracking",
+			params={"shipmentid": shipment_id},
+			headers={"Content-Type": "application/json", "Accept": "application/json"},
+			endpoint="tracking",
+		)
+		return get_letmeship_tracking_info(response.json())
+
+
+def get_label_content(data: list[int] | str) -> bytes:
+	"""Return the PDF of a label, which LetMeShip sends as a byte array or a base64 string."""
+	if isinstance(data, str):
+		return base64.b64decode(data)
+
+	return bytes(data)
+
+
+def get_letmeship_tracking_info(tracking_data: dict) -> dict | None:
+	from erpnext_shipping.erpnext_shipping.utils import get_tracking_url
+
+	if "awbNumber" in tracking_data:
+		tracking_status = "In Progress"
+		if tracking_data["lmsTrackingStatus"].startswith("DELIVERED"):
+			tracking_status = "Delivered"
+		if tracking_data["lmsTrackingStatus"] == "RETURNED":
+			tracking_status = "Returned"
+		if tracking_data["lmsTrackingStatus"] == "LOST":
+			tracking_status = "Lost"
+		tracking_url = get_tracking_url(
+			carrier=tracking_data["carrier"], tracking_number=tracking_data["awbNumber"]
+		)
+		return {
+			"awb_number": tracking_data["awbNumber"],
+			"tracking_status": tracking_status,
+			"tracking_status_info": tracking_data["lmsTrackingStatus"],
+			"tracking_url": tracking_url,
+		}
+	elif "message" in tracking_data:
+		frappe.throw(_("Error occurred while updating Shipment: {0}").format(tracking_data["message"]))
+
+
+def get_letmeship_settings():
 	settings = frappe.get_single("LetMeShip")
 	if not settings.enabled:
 		link = get_link_to_form("LetMeShip", "LetMeShip", frappe.bold("LetMeShip Settings"))
 		frappe.throw(_(f"Please enable LetMeShip Integration in {link}"), title=_("Mandatory"))
 
-	return LetMeShipUtils(
+	return frappe._dict(
 		base_url=TEST_BASE_URL if settings.use_test_environment else PROD_BASE_URL,
 		api_id=settings.api_id,
-		api_password=settings.get_password("api_password")
+		api_password=settings.get_password("api_password"),
+	)
+
+
+def get_letmeship_utils() -> "LetMeShipUtils":
+	return LetMeShipUtils(**get_letmeship_settings())
+
+
+def get_async_letmeship() -> AsyncLetMeShip:
+	return AsyncLetMeShip(**get_letmeship_settings())
+
+
+def get_letmeship_rates(rate_request) -> list[dict]:
+	"""Rate provider for LetMeShip, registered via the `shipping_rate_providers` hook."""
+	from erpnext_shipping.erpnext_shipping.utils import get_shipment_contacts
+
+	pickup_contact, delivery_contact = get_shipment_contacts(
+		rate_request.pickup_from_type,
+		rate_request.delivery_to_type,
+		rate_request.pickup_contact_name,
+		rate_request.delivery_contact_name,
+	)
+
+	letmeship = get_letmeship_utils()
+	return letmeship.get_available_services(
+		delivery_to_type=rate_request.delivery_to_type,
+		pickup_address=rate_request.pickup_address,
+		delivery_address=rate_request.delivery_address,
+		parcels=rate_request.parcels,
+		description_of_content=rate_request.description_of_content,
+		pickup_date=rate_request.pickup_date,
+		value_of_goods=rate_request.value_of_goods,
+		pickup_contact=pickup_contact,
+		delivery_contact=delivery_contact,
+		# failures are reported by the caller, which must not cache a partial quote
+		raise_exception=True,
 	)
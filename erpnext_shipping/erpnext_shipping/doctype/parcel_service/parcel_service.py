@@ -4,6 +4,17 @@
 import frappe
 from frappe.model.document import Document
 
+from erpnext_shipping.erpnext_shipping.doctype.parcel_service_type.parcel_service_type import (
+	clear_parcel_service_type_index,
+)
+
 
 class ParcelService(Document):
-	pass
+	def on_update(self):
+		clear_parcel_service_type_index()
+
+	def on_trash(self):
+		clear_parcel_service_type_index()
+
+	def after_rename(self, old, new, merge=False):
+		clear_parcel_service_type_index()
@@ -3,20 +3,73 @@
 
 import frappe
 from frappe.model.document import Document
+from frappe.utils import cstr
+
+PARCEL_SERVICE_TYPE_INDEX_KEY = "parcel_service_type_index"
 
 
 class ParcelServiceType(Document):
-	pass
+	def on_update(self):
+		clear_parcel_service_type_index()
+
+	def on_trash(self):
+		clear_parcel_service_type_index()
+
+	def after_rename(self, old, new, merge=False):
+		clear_parcel_service_type_index()
 
 
 def match_parcel_service_type_alias(parcel_service_type, parcel_service):
 	# Match and return Parcel Service Type Alias to Parcel Service Type if exists.
-	if frappe.db.exists("Parcel Service", parcel_service):
-		matched_parcel_service_type = frappe.db.get_value(
-			"Parcel Service Type Alias",
-			{"parcel_type_alias": parcel_service_type, "parcel_service": parcel_service},
-			"parent",
+	match = get_parcel_service_type_index().get(get_index_key(parcel_service, parcel_service_type))
+	return match[0] if match else parcel_service_type
+
+
+def get_parcel_service_type_index() -> dict:
+	"""Return {(parcel service, service name or alias): (Parcel Service Type, is preferred)}.
+
+	Keys are lower case, as the database compares them case insensitively.
+	"""
+	return frappe.cache().get_value(PARCEL_SERVICE_TYPE_INDEX_KEY, generator=build_parcel_service_type_index)
+
+
+def build_parcel_service_type_index() -> dict:
+	parcel_service_type = frappe.qb.DocType("Parcel Service Type")
+	alias = frappe.qb.DocType("Parcel Service Type Alias")
+	rows = (
+		frappe.qb.from_(parcel_service_type)
+		.left_join(alias)
+		.on((alias.parent == parcel_service_type.name) & (alias.parenttype == "Parcel Service Type"))
+		.select(
+			parcel_service_type.name,
+			parcel_service_type.parcel_service,
+			parcel_service_type.parcel_service_type,
+			parcel_service_type.show_in_preferred_services_list,
+			alias.parcel_service.as_("alias_parcel_service"),
+			alias.parcel_type_alias,
 		)
-		if matched_parcel_service_type:
-			parcel_service_type = matched_parcel_service_type
-	return parcel_service_type
+		.run(as_dict=True)
+	)
+
+	index = {}
+	for row in rows:
+		match = (row.name, row.show_in_preferred_services_list)
+		index[get_index_key(row.parcel_service, row.parcel_service_type)] = match
+		if row.parcel_type_alias:
+			index[get_index_key(row.alias_parcel_service or row.parcel_service, row.parcel_type_alias)] = (
+				match
+			)
+
+	return index
+
+
+def get_index_key(parcel_service, service_name) -> tuple:
+	return (cstr(parcel_service).strip().lower(), cstr(service_name).strip().lower())
+
+
+def clear_parcel_service_type_index():
+	from erpnext_shipping.erpnext_shipping.providers import clear_rate_cache
+
+	frappe.cache().delete_value(PARCEL_SERVICE_TYPE_INDEX_KEY)
+	# cached quotes carry the preference of their Parcel Service Type
+	clear_rate_cache()
@@ -1,23 +1,46 @@
 # Copyright (c) 2020, Frappe Technologies Pvt. Ltd. and contributors
 # For license information, please see license.txt
 
+import asyncio
+import hashlib
+import hmac
 import json
+import os
+import time
+from bisect import bisect_left, bisect_right
 
 import frappe
-import requests
 from frappe import _
 from frappe.model.document import Document
 from frappe.utils import flt
 from frappe.utils.data import get_link_to_form
-from requests.exceptions import HTTPError
+from requests.exceptions import RequestException
 
+from erpnext_shipping.erpnext_shipping import http_client, rate_limiter
+from erpnext_shipping.erpnext_shipping.async_client import AsyncProvider, call_sync
+from erpnext_shipping.erpnext_shipping.circuit_breaker import ProviderUnavailableError
+from erpnext_shipping.erpnext_shipping.concurrency import SiteThreadPoolExecutor
+from erpnext_shipping.erpnext_shipping.providers import clear_rate_cache
 from erpnext_shipping.erpnext_shipping.utils import show_error_alert
 
 SENDCLOUD_PROVIDER = "SendCloud"
+SHIPPING_METHODS_CACHE_KEY = "sendcloud_shipping_methods"
+LABEL_WORKERS = 8
+LABEL_CHUNK_SIZE = 64 * 1024
+# Parcel ids per request to the parcels list endpoint
+PARCELS_PER_REQUEST = 100
+
+# Seconds a cached shipping method catalog is served as fresh, and for how long
+# after that it is still served while being refreshed in the background.
+# Override with `sendcloud_catalog_ttl` and `sendcloud_catalog_stale_ttl` in site config.
+DEFAULT_CATALOG_TTL = 6 * 60 * 60
+DEFAULT_CATALOG_STALE_TTL = 24 * 60 * 60
 
 
 class SendCloud(Document):
-	pass
+	def on_update(self):
+		clear_shipping_methods_cache()
+		clear_rate_cache()
 
 
 class SendCloudUtils:
@@ -31,7 +54,7 @@ class SendCloudUtils:
 			link = get_link_to_form("SendCloud", "SendCloud", _("SendCloud Settings"))
 			frappe.throw(_("Please enable SendCloud Integration in {0}").format(link))
 
-	def get_available_services(self, delivery_address, parcels: list[dict]):
+	def get_available_services(self, delivery_address, parcels: list[dict], raise_exception=False):
 		# Retrieve rates at SendCloud from specification stated.
 		if not self.enabled or not self.api_key or not self.api_secret:
 			return []
@@ -39,37 +62,75 @@ class SendCloudUtils:
 		to_country = delivery_address.country_code.upper()
 
 		try:
-			response = requests.get(
-				"https://panel.sendcloud.sc/api/v2/shipping_methods",
-				params={
-					"to_country": to_country,
-				},
-				auth=(self.api_key, self.api_secret),
-			)
-			responses_dict = response.json()
-
-			if "error" in responses_dict:
-				error_message = responses_dict["error"]["message"]
-				frappe.throw(error_message, title=_("SendCloud"))
-
-			available_services = []
-			for service in responses_dict.get("shipping_methods", []):
-				countries = [
-					country
-					for country in service["countries"]
-					if country["iso_2"] == to_country
-				]
-
-				if countries and check_weight(service, parcels):
-					available_service = self.get_service_dict(
-						service, countries[0], parcels
-					)
-					available_services.append(available_service)
-
-			return available_services
+			country_methods = self.get_country_methods(to_country)
+			if not country_methods:
+				return []
+
+			return [
+				self.get_service_dict(method, parcels)
+				for method in get_matching_methods(country_methods, parcels)
+			]
 		except Exception:
+			if raise_exception:
+				raise
 			show_error_alert("fetching SendCloud prices")
 
+	def get_country_methods(self, to_country: str) -> dict | None:
+		"""Return the indexed shipping methods to a country, cached per account.
+
+		See `build_catalog_index` for the structure of one country. A cached
+		catalog older than the TTL is still returned, but a refresh is enqueued so
+		that the next request gets an up to date catalog.
+		"""
+		cached = frappe.cache().get_value(self.get_shipping_methods_cache_key(to_country))
+		if not cached or "country_methods" not in cached:
+			return self.refresh_shipping_methods(to_country)
+
+		if time.time() - cached["fetched_at"] > get_catalog_ttl():
+			frappe.enqueue(
+				"erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud.refresh_shipping_methods",
+				queue="short",
+				job_id=f"{SHIPPING_METHODS_CACHE_KEY}::{to_country}",
+				deduplicate=True,
+				to_country=to_country,
+			)
+
+		return cached["country_methods"]
+
+	def refresh_shipping_methods(
+		self, to_country: str, priority: str = rate_limiter.INTERACTIVE
+	) -> dict | None:
+		"""Download the shipping methods to a country, index them and store the index in the cache."""
+		response = http_client.get(
+			SENDCLOUD_PROVIDER,
+			"https://panel.sendcloud.sc/api/v2/shipping_methods",
+			params={
+				"to_country": to_country,
+			},
+			auth=(self.api_key, self.api_secret),
+			endpoint="shipping_methods",
+			priority=priority,
+		)
+		responses_dict = response.json()
+
+		if "error" in responses_dict:
+			error_message = responses_dict["error"]["message"]
+			frappe.throw(error_message, title=_("SendCloud"))
+
+		# methods also list the other countries they ship to, only this one is ever read
+		country_methods = build_catalog_index(responses_dict.get("shipping_methods", [])).get(to_country)
+		frappe.cache().set_value(
+			self.get_shipping_methods_cache_key(to_country),
+			{"fetched_at": time.time(), "country_methods": country_methods},
+			expires_in_sec=get_catalog_ttl() + get_catalog_stale_ttl(),
+		)
+		return country_methods
+
+	def get_shipping_methods_cache_key(self, to_country: str) -> str:
+		# the account is an API key, keep it out of the key names
+		account_hash = hashlib.sha256((self.api_key or "").encode()).hexdigest()[:16]
+		return f"{SHIPPING_METHODS_CACHE_KEY}::{account_hash}::{to_country}"
+
 	def create_shipment(
 		self,
 		shipment,
@@ -85,6 +146,42 @@ class SendCloudUtils:
 		if not self.enabled or not self.api_key or not self.api_secret:
 			return []
 
+		parcels = self.get_shipment_parcels(
+			shipment,
+			delivery_company_name,
+			delivery_address,
+			delivery_contact,
+			service_info,
+			shipment_parcel,
+			description_of_content,
+			value_of_goods,
+		)
+
+		try:
+			response_data = self.create_parcels(parcels)
+			if "failed_parcels" in response_data:
+				error = response_data["failed_parcels"][0]["errors"]
+				frappe.msgprint(
+					_("Error occurred while creating Shipment: {0}").format(error),
+					indicator="orange",
+					alert=True,
+				)
+			else:
+				return self.get_shipment_info(response_data["parcels"], service_info)
+		except Exception:
+			show_error_alert("creating SendCloud Shipment")
+
+	def get_shipment_parcels(
+		self,
+		shipment,
+		delivery_company_name,
+		delivery_address,
+		delivery_contact,
+		service_info,
+		shipment_parcel,
+		description_of_content,
+		value_of_goods,
+	) -> list[dict]:
 		parcels = []
 		for i, parcel in enumerate(json.loads(shipment_parcel), start=1):
 			parcel_data = self.get_parcel_dict(
@@ -99,48 +196,38 @@ class SendCloudUtils:
 				value_of_goods,
 			)
 			parcels.append(parcel_data)
-
-		try:
-			response = requests.post(
-				"https://panel.sendcloud.sc/api/v2/parcels?errors=verbose",
-				json={"parcels": parcels},
-				auth=(self.api_key, self.api_secret),
-			)
-			response_data = response.json()
-			if "failed_parcels" in response_data:
-				error = response_data["failed_parcels"][0]["errors"]
-				frappe.msgprint(
-					_("Error occurred while creating Shipment: {0}").format(error),
-					indicator="orange",
-					alert=True,
-				)
-			else:
-				shipment_id = ", ".join([str(x["id"]) for x in response_data["parcels"]])
-				awb_number = ", ".join([str(x["tracking_number"]) for x in response_data["parcels"]])
-				return {
-					"service_provider": "SendCloud",
-					"shipment_id": shipment_id,
-					"carrier": self.get_carrier(service_info["carrier"], post_or_get="post"),
-					"carrier_service": service_info["service_name"],
-					"shipment_amount": service_info["total_price"],
-					"awb_number": awb_number,
-				}
-		except Exception:
-			show_error_alert("creating SendCloud Shipment")
+		return parcels
+
+	def create_parcels(self, parcels: list[dict]) -> dict:
+		"""Create parcels at SendCloud, possibly belonging to several Shipments, with one request."""
+		response = http_client.post(
+			SENDCLOUD_PROVIDER,
+			"https://panel.sendcloud.sc/api/v2/parcels?errors=verbose",
+			json={"parcels": parcels},
+			auth=(self.api_key, self.api_secret),
+			endpoint="shipments",
+		)
+		return response.json()
+
+	def get_shipment_info(self, parcels: list[dict], service_info) -> dict:
+		shipment_id = ", ".join([str(x["id"]) for x in parcels])
+		awb_number = ", ".join([str(x["tracking_number"]) for x in parcels])
+		return {
+			"service_provider": "SendCloud",
+			"shipment_id": shipment_id,
+			"carrier": self.get_carrier(service_info["carrier"], post_or_get="post"),
+			"carrier_service": service_info["service_name"],
+			"shipment_amount": service_info["total_price"],
+			"awb_number": awb_number,
+		}
 
 	def get_label(self, shipment_id):
 		# Retrieve shipment label from SendCloud
 		shipment_id_list = shipment_id.split(", ")
-		label_urls = []
 
 		try:
-			for ship_id in shipment_id_list:
-				shipment_label_response = requests.get(
-					f"https://panel.sendcloud.sc/api/v2/labels/{ship_id}",
-					auth=(self.api_key, self.api_secret),
-				)
-				shipment_label = json.loads(shipment_label_response.text)
-				label_urls.append(shipment_label["label"]["label_printer"])
+			engine = AsyncSendCloud(self.api_key, self.api_secret)
+			label_urls = call_sync(engine, "get_label_urls", shipment_id_list)
 			if len(label_urls):
 				return label_urls
 			else:
@@ -151,42 +238,49 @@ class SendCloudUtils:
 		except Exception:
 			show_error_alert("printing SendCloud Label")
 
-	def download_label(self, label_url: str):
-		"""Download label from SendCloud."""
+	def get_label_url(self, parcel_id: str) -> str:
+		shipment_label_response = http_client.get(
+			SENDCLOUD_PROVIDER,
+			f"https://panel.sendcloud.sc/api/v2/labels/{parcel_id}",
+			auth=(self.api_key, self.api_secret),
+			endpoint="labels",
+		)
+		shipment_label = json.loads(shipment_label_response.text)
+		return shipment_label["label"]["label_printer"]
+
+	def download_labels(self, label_urls: list[str], target_dir: str) -> list[str]:
+		"""Download labels in parallel into `target_dir` and return their paths, in order."""
+		label_paths = [os.path.join(target_dir, f"label_{idx}.pdf") for idx in range(len(label_urls))]
 		try:
-			resp = requests.get(label_url, auth=(self.api_key, self.api_secret))
-			resp.raise_for_status()
-			return resp.content
-		except HTTPError:
+			with SiteThreadPoolExecutor(max_workers=min(len(label_urls), LABEL_WORKERS)) as executor:
+				list(executor.map(self.download_label_to_file, label_urls, label_paths))
+		except RequestException:
 			frappe.msgprint(
 				_("An error occurred while downloading label from SendCloud"), indicator="orange", alert=True
 			)
+			return []
+
+		return label_paths
+
+	def download_label_to_file(self, label_url: str, path: str):
+		"""Stream a label from SendCloud to disk, without holding it in memory."""
+		with http_client.get(
+			SENDCLOUD_PROVIDER,
+			label_url,
+			auth=(self.api_key, self.api_secret),
+			stream=True,
+			endpoint="labels",
+		) as resp:
+			resp.raise_for_status()
+			with open(path, "wb") as f:
+				for chunk in resp.iter_content(chunk_size=LABEL_CHUNK_SIZE):
+					f.write(chunk)
 
 	def get_tracking_data(self, shipment_id):
 		# return SendCloud tracking data
 		try:
-			shipment_id_list = shipment_id.split(", ")
-			awb_number, tracking_status, tracking_status_info, tracking_urls = [], [], [], []
-
-			for ship_id in shipment_id_list:
-				tracking_data_response = requests.get(
-					f"https://panel.sendcloud.sc/api/v2/parcels/{ship_id}",
-					auth=(self.api_key, self.api_secret),
-				)
-				tracking_data = json.loads(tracking_data_response.text)
-				tracking_data_parcel = tracking_data["parcel"]
-				tracking_data_parcel_status = tracking_data_parcel["status"]["message"]
-
-				tracking_urls.append(tracking_data_parcel["tracking_url"])
-				awb_number.append(tracking_data_parcel["tracking_number"])
-				tracking_status.append(tracking_data_parcel_status)
-				tracking_status_info.append(tracking_data_parcel_status)
-			return {
-				"awb_number": ", ".join(awb_number),
-				"tracking_status": ", ".join(tracking_status),
-				"tracking_status_info": ", ".join(tracking_status_info),
-				"tracking_url": ", ".join(tracking_urls),
-			}
+			engine = AsyncSendCloud(self.api_key, self.api_secret)
+			return call_sync(engine, "get_tracking_data", shipment_id)
 		except Exception:
 			show_error_alert("updating SendCloud Shipment")
 
@@ -206,17 +300,14 @@ class SendCloudUtils:
 		parcel_list.append(formatted_parcel)
 		return parcel_list
 
-	def get_service_dict(self, service, country, parcels: list[dict]):
-		"""Returns a dictionary with service info."""
+	def get_service_dict(self, method: dict, parcels: list[dict]):
+		"""Returns a dictionary with service info for a method of the catalog index."""
 		available_service = frappe._dict()
 		available_service.service_provider = "SendCloud"
-		available_service.carrier = self.get_carrier(service["carrier"], post_or_get="get")
-		available_service.service_name = service["name"]
-
-		price = country["price"] or sum(price_part["value"] for price_part in country["price_breakdown"])
-		available_service.total_price = self.total_parcel_price(price, parcels)
-
-		available_service.service_id = service["id"]
+		available_service.carrier = self.get_carrier(method["carrier"], post_or_get="get")
+		available_service.service_name = method["name"]
+		available_service.total_price = self.total_parcel_price(method["price"], parcels)
+		available_service.service_id = method["id"]
 
 		return available_service
 
@@ -260,6 +351,246 @@ class SendCloudUtils:
 		}
 
 
+def get_catalog_ttl() -> int:
+	return frappe.conf.get("sendcloud_catalog_ttl") or DEFAULT_CATALOG_TTL
+
+
+def get_catalog_stale_ttl() -> int:
+	return frappe.conf.get("sendcloud_catalog_stale_ttl") or DEFAULT_CATALOG_STALE_TTL
+
+
+def refresh_shipping_methods(to_country: str):
+	SendCloudUtils().refresh_shipping_methods(to_country, priority=rate_limiter.BACKGROUND)
+
+
+def clear_shipping_methods_cache():
+	frappe.cache().delete_keys(SHIPPING_METHODS_CACHE_KEY)
+
+
+class AsyncSendCloud(AsyncProvider):
+	name = SENDCLOUD_PROVIDER
+
+	def __init__(self, api_key: str, api_secret: str):
+		self.api_key = api_key
+		self.api_secret = api_secret
+
+	def get_auth(self):
+		return (self.api_key, self.api_secret)
+
+	async def get_tracking_data(self, shipment_id):
+		parcels = await self.get_parcels(shipment_id.split(", "))
+		return get_shipment_tracking_info(shipment_id, parcels)
+
+	async def get_tracking_data_batch(self, shipment_ids: list[str]) -> dict:
+		"""Fetch the parcels of all Shipments together, `PARCELS_PER_REQUEST` per request."""
+		parcel_ids = list(
+			dict.fromkeys(parcel_id for shipment_id in shipment_ids for parcel_id in shipment_id.split(", "))
+		)
+		parcels = await self.get_parcels(parcel_ids)
+
+		results = {}
+		for shipment_id in shipment_ids:
+			try:
+				results[shipment_id] = get_shipment_tracking_info(shipment_id, parcels)
+			except Exception as e:
+				results[shipment_id] = e
+
+		return results
+
+	async def get_label_urls(self, parcel_ids: list[str]) -> list[str]:
+		parcels = await self.get_parcels(parcel_ids, endpoint="labels")
+		return [parcels[parcel_id]["label"]["label_printer"] for parcel_id in parcel_ids]
+
+	async def get_parcels(self, parcel_ids: list[str], endpoint: str = "tracking") -> dict:
+		"""Return {parcel id: parcel}, missing the parcels that could not be fetched."""
+		batches = await asyncio.gather(
+			*(
+				self.get_parcel_batch(parcel_ids[idx : idx + PARCELS_PER_REQUEST], endpoint)
+				for idx in range(0, len(parcel_ids), PARCELS_PER_REQUEST)
+			)
+		)
+		return {parcel_id: parcel for batch in batches for parcel_id, parcel in batch.items()}
+
+	async def get_parcel_batch(self, parcel_ids: list[str], endpoint: str) -> dict:
+		"""Fetch many parcels with one request, and the ones it didn't return one by one."""
+		parcels = {}
+		try:
+			response = await self.client.get(
+				"https://panel.sendcloud.sc/api/v2/parcels",
+				params={"ids": ",".join(parcel_ids)},
+				endpoint=endpoint,
+			)
+			if response.is_success:
+				parcels = {str(parcel["id"]): parcel for parcel in response.json()["parcels"]}
+		except ProviderUnavailableError:
+			raise
+		except Exception:
+			frappe.log_error(title="SendCloud Error")
+
+		missing = [parcel_id for parcel_id in parcel_ids if parcel_id not in parcels]
+		if missing:
+			# the calls are bounded by the client's concurrency
+			fetched = await asyncio.gather(
+				*(self.get_parcel(parcel_id, endpoint) for parcel_id in missing), return_exceptions=True
+			)
+			for parcel_id, parcel in zip(missing, fetched):
+				if not isinstance(parcel, BaseException):
+					parcels[parcel_id] = parcel
+
+		return parcels
+
+	async def get_parcel(self, parcel_id: str, endpoint: str = "tracking") -> dict:
+		response = await self.client.get(
+			f"https://panel.sendcloud.sc/api/v2/parcels/{parcel_id}", endpoint=endpoint
+		)
+		return response.json()["parcel"]
+
+
+def get_async_sendcloud() -> AsyncSendCloud:
+	utils = SendCloudUtils()
+	return AsyncSendCloud(utils.api_key, utils.api_secret)
+
+
+def get_shipment_tracking_info(shipment_id: str, parcels: dict) -> dict:
+	"""Return the tracking info of a Shipment, given {parcel id: parcel} including all of its parcels."""
+	parcels_tracking_info = [
+		get_parcel_tracking_info(parcels[parcel_id]) for parcel_id in shipment_id.split(", ")
+	]
+	return {
+		field: ", ".join(info[field] for info in parcels_tracking_info)
+		for field in ("awb_number", "tracking_status", "tracking_status_info", "tracking_url")
+	}
+
+
+def get_parcel_tracking_info(parcel: dict) -> dict:
+	"""Return the tracking info of a single SendCloud parcel."""
+	status = parcel["status"]["message"]
+	return {
+		"awb_number": parcel["tracking_number"],
+		"tracking_status": status,
+		"tracking_status_info": status,
+		"tracking_url": parcel["tracking_url"],
+	}
+
+
+@frappe.whitelist(allow_guest=True, methods=["POST"])
+def handle_webhook():
+	"""Receive parcel status updates pushed by SendCloud.
+
+	Configure `/api/method/erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud.handle_webhook`
+	as webhook URL of the SendCloud integration.
+	"""
+	from erpnext_shipping.erpnext_shipping.tracking import update_parcel_tracking
+
+	payload = frappe.request.get_data()
+	if not is_valid_webhook_signature(payload, frappe.get_request_header("Sendcloud-Signature")):
+		raise frappe.AuthenticationError
+
+	data = json.loads(payload)
+	if data.get("action") != "parcel_status_changed":
+		return
+
+	parcel = data["parcel"]
+	parcel_id = str(parcel["id"])
+	shipment = get_shipment_by_parcel(parcel_id, parcel.get("tracking_number"))
+	if shipment:
+		update_parcel_tracking(shipment, parcel_id, get_parcel_tracking_info(parcel))
+
+
+def is_valid_webhook_signature(payload: bytes, signature: str | None) -> bool:
+	if not signature:
+		return False
+
+	api_secret = frappe.get_single("SendCloud").get_password("api_secret", raise_exception=False)
+	if not api_secret:
+		return False
+
+	expected_signature = hmac.new(api_secret.encode(), payload, hashlib.sha256).hexdigest()
+	return hmac.compare_digest(expected_signature, signature)
+
+
+def get_shipment_by_parcel(parcel_id: str, tracking_number: str | None = None) -> str | None:
+	"""Return the booked SendCloud Shipment that contains a parcel.
+
+	Single parcel Shipments are found by an exact match on the indexed
+	`shipment_id` or `awb_number`. The parcels of multi parcel Shipments are
+	comma separated there, so these are found by their Shipment Tracking
+	Events, which are recorded per parcel from booking on.
+	"""
+	filters = {"service_provider": SENDCLOUD_PROVIDER, "docstatus": 1}
+	shipment = frappe.db.get_value("Shipment", {**filters, "shipment_id": parcel_id})
+	if not shipment and tracking_number:
+		shipment = frappe.db.get_value("Shipment", {**filters, "awb_number": tracking_number})
+	if shipment:
+		return shipment
+
+	candidates = frappe.get_all(
+		"Shipment Tracking Event", filters={"parcel_id": parcel_id}, pluck="shipment", distinct=True
+	)
+	if not candidates and tracking_number:
+		candidates = frappe.get_all(
+			"Shipment Tracking Event",
+			filters={"awb_number": tracking_number},
+			pluck="shipment",
+			distinct=True,
+		)
+
+	if candidates:
+		return frappe.db.get_value("Shipment", {**filters, "name": ["in", candidates]})
+
+
+def build_catalog_index(shipping_methods: list[dict]) -> dict:
+	"""Return {country: methods} for a SendCloud catalog.
+
+	The methods of each country are sorted by their minimum weight, with the
+	weight bounds as floats and the price to that country already resolved.
+	`min_weights` holds the minimum weights in the same order for bisecting.
+	"""
+	index = {}
+	for service in shipping_methods:
+		min_weight = float(service["min_weight"])
+		max_weight = float(service["max_weight"])
+		for country in service["countries"]:
+			price = country["price"] or sum(price_part["value"] for price_part in country["price_breakdown"])
+			index.setdefault(country["iso_2"], []).append(
+				{
+					"id": service["id"],
+					"name": service["name"],
+					"carrier": service["carrier"],
+					"min_weight": min_weight,
+					"max_weight": max_weight,
+					"price": price,
+				}
+			)
+
+	for country, methods in index.items():
+		methods.sort(key=lambda method: method["min_weight"])
+		index[country] = {"min_weights": [method["min_weight"] for method in methods], "methods": methods}
+
+	return index
+
+
+def get_matching_methods(country_methods: dict, parcels: list[dict]) -> list[dict]:
+	"""Return the methods of one country that can carry at least one of the parcels.
+
+	Same rule as `check_weight`, but with range lookups: only methods whose
+	minimum weight is below the heaviest parcel are looked at, and for each of
+	them the lightest parcel above its minimum weight decides.
+	"""
+	weights = sorted(flt(parcel.get("weight")) for parcel in parcels)
+	if not weights:
+		return []
+
+	candidates = bisect_right(country_methods["min_weights"], weights[-1])
+	matching_methods = []
+	for method in country_methods["methods"][:candidates]:
+		idx = bisect_left(weights, method["min_weight"])
+		if idx < len(weights) and weights[idx] < method["max_weight"]:
+			matching_methods.append(method)
+
+	return matching_methods
+
+
 def check_weight(service: dict, parcels: list[dict]) -> bool:
 	"""Check if the weight of any parcel is within the range of the service."""
 	max_weight_kg = float(service["max_weight"])
@@ -268,3 +599,15 @@ def check_weight(service: dict, parcels: list[dict]) -> bool:
 		max_weight_kg > parcel.get("weight") and min_weight_kg <= parcel.get("weight")
 		for parcel in parcels
 	)
+
+
+def get_sendcloud_rates(rate_request) -> list[dict]:
+	"""Rate provider for SendCloud, registered via the `shipping_rate_providers` hook."""
+	if rate_request.pickup_from_type != "Company":
+		return []
+
+	sendcloud = SendCloudUtils()
+	# failures are reported by the caller, which must not cache a partial quote
+	return sendcloud.get_available_services(
+		delivery_address=rate_request.delivery_address, parcels=rate_request.parcels, raise_exception=True
+	)
@@ -4,6 +4,47 @@
 # import frappe
 import unittest
 
+from erpnext_shipping.erpnext_shipping.benchmarks.runner import load_fixture
+from erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud import (
+	build_catalog_index,
+	check_weight,
+	get_matching_methods,
+)
+
+PARCEL_WEIGHTS = [
+	[],
+	[0.5],
+	[2.001],
+	[2.0009],
+	[31.5],
+	[40],
+	[0.0005],
+	[1, 1, 1],
+	[0.5, 12],
+	[25, 3.2, 0.8],
+	[40, 0.0005],
+	[5.001, 10.001, 20.001],
+]
+
 
 class TestSendCloud(unittest.TestCase):
-	pass
+	def test_matching_methods_equal_check_weight(self):
+		shipping_methods = load_fixture("sendcloud_shipping_methods")["shipping_methods"]
+		index = build_catalog_index(shipping_methods)
+
+		for country, country_methods in index.items():
+			country_services = [
+				service
+				for service in shipping_methods
+				if any(c["iso_2"] == country for c in service["countries"])
+			]
+			for weights in PARCEL_WEIGHTS:
+				parcels = [{"weight": weight} for weight in weights]
+				with self.subTest(country=country, weights=weights):
+					expected = sorted(
+						service["id"] for service in country_services if check_weight(service, parcels)
+					)
+					matching = sorted(
+						method["id"] for method in get_matching_methods(country_methods, parcels)
+					)
+					self.assertEqual(matching, expected)
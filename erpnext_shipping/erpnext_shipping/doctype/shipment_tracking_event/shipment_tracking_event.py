@@ -0,0 +1,14 @@
+# Copyright (c) 2026, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class ShipmentTrackingEvent(Document):
+	pass
+
+
+def on_doctype_update():
+	# the latest event of each parcel is looked up for every tracking change
+	frappe.db.add_index("Shipment Tracking Event", ["shipment", "parcel_id", "creation"])
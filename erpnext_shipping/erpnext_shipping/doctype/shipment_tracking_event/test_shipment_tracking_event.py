@@ -0,0 +1,9 @@
+# Copyright (c) 2026, Frappe and Contributors
+# See license.txt
+
+# import frappe
+import unittest
+
+
+class TestShipmentTrackingEvent(unittest.TestCase):
+	pass
@@ -0,0 +1,154 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+import os
+import threading
+import time
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+
+from erpnext_shipping.erpnext_shipping import circuit_breaker, metrics, rate_limiter
+
+# (connect, read) timeout in seconds, override with `shipping_http_timeout` in site config.
+DEFAULT_TIMEOUT = (5, 30)
+# Retries of idempotent requests, override with `shipping_http_retries` in site config.
+DEFAULT_RETRIES = 2
+BACKOFF_FACTOR = 0.5
+MAX_BACKOFF = 10
+POOL_SIZE = 20
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(provider: str) -> requests.Session:
+	"""Return the session of this process for a provider.
+
+	Sessions keep connections to the provider alive, so that consecutive calls
+	(e.g. while tracking many shipments) skip the TCP and TLS handshake.
+	"""
+	key = (os.getpid(), provider)
+	session = _sessions.get(key)
+	if session is None:
+		with _sessions_lock:
+			session = _sessions.get(key)
+			if session is None:
+				session = _sessions[key] = make_session()
+
+	return session
+
+
+def make_session() -> requests.Session:
+	adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+	session = requests.Session()
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	session.headers.update({"Accept-Encoding": "gzip, deflate"})
+	return session
+
+
+def get(provider: str, url: str, **kwargs) -> requests.Response:
+	return request(provider, "GET", url, **kwargs)
+
+
+def post(provider: str, url: str, **kwargs) -> requests.Response:
+	return request(provider, "POST", url, **kwargs)
+
+
+def request(
+	provider: str,
+	method: str,
+	url: str,
+	idempotent=None,
+	endpoint: str | None = None,
+	priority: str = rate_limiter.INTERACTIVE,
+	**kwargs,
+) -> requests.Response:
+	"""Send a request to a provider through its pooled session.
+
+	Idempotent requests are retried with exponential backoff on connection
+	errors, timeouts and retryable status codes. Other requests (e.g. booking a
+	shipment) are only retried when the connection could not be established.
+	Pass `idempotent=True` for POST requests that only read data.
+
+	Every attempt is counted in the provider metrics under `endpoint`, one of
+	`metrics.ENDPOINTS`, and waits for the provider account's rate limit.
+	Background work passes `priority=rate_limiter.BACKGROUND`. Responses with
+	status 429 are always retried, once the provider allows it again.
+
+	Raises `circuit_breaker.ProviderUnavailableError` without sending anything
+	while the provider's circuit is open.
+	"""
+	if idempotent is None:
+		idempotent = method.upper() in IDEMPOTENT_METHODS
+
+	kwargs.setdefault("timeout", get_timeout())
+	circuit_breaker.check_circuit(provider)
+	try:
+		response = send_with_retries(provider, method, url, idempotent, endpoint, priority, **kwargs)
+	except (ConnectionError, Timeout):
+		circuit_breaker.record_failure(provider)
+		raise
+
+	if response.status_code >= 500:
+		circuit_breaker.record_failure(provider)
+	else:
+		circuit_breaker.record_success(provider)
+
+	return response
+
+
+def send_with_retries(
+	provider: str, method: str, url: str, idempotent: bool, endpoint: str | None, priority: str, **kwargs
+) -> requests.Response:
+	retries = get_retries()
+	session = get_session(provider)
+	account = rate_limiter.get_account(kwargs.get("auth"))
+
+	for attempt in range(retries + 1):
+		is_last_attempt = attempt == retries
+		rate_limiter.acquire(provider, account, priority)
+		try:
+			response = send(session, provider, endpoint, method, url, **kwargs)
+		except ConnectTimeout:
+			if is_last_attempt:
+				raise
+		except (ConnectionError, Timeout):
+			if is_last_attempt or not idempotent:
+				raise
+		else:
+			if response.status_code == 429:
+				rate_limiter.throttle(provider, account, response.headers.get("Retry-After"))
+				if not is_last_attempt:
+					# the rate limiter waits until the provider accepts requests again
+					continue
+
+			if is_last_attempt or not idempotent or response.status_code not in RETRY_STATUS_CODES:
+				return response
+
+		time.sleep(min(BACKOFF_FACTOR * (2**attempt), MAX_BACKOFF))
+
+
+def send(session: requests.Session, provider: str, endpoint: str | None, method: str, url: str, **kwargs):
+	start = time.monotonic()
+	response = None
+	try:
+		response = session.request(method, url, **kwargs)
+		return response
+	finally:
+		metrics.record(
+			provider, endpoint, time.monotonic() - start, success=response is not None and response.ok
+		)
+
+
+def get_timeout() -> tuple:
+	return tuple(frappe.conf.get("shipping_http_timeout") or DEFAULT_TIMEOUT)
+
+
+def get_retries() -> int:
+	retries = frappe.conf.get("shipping_http_retries")
+	return DEFAULT_RETRIES if retries is None else retries
@@ -0,0 +1,168 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+import threading
+import time
+from bisect import bisect_left
+
+import frappe
+
+METRICS_KEY = "shipping_metrics"
+ENDPOINTS = ("available", "shipments", "labels", "tracking", "shipping_methods")
+# Upper bounds of the latency buckets in milliseconds, the last bucket takes the rest
+LATENCY_BUCKETS = (
+	10,
+	25,
+	50,
+	100,
+	250,
+	500,
+	750,
+	1000,
+	1500,
+	2000,
+	3000,
+	5000,
+	7500,
+	10000,
+	20000,
+	30000,
+	60000,
+)
+# Calls are aggregated per hour
+WINDOW = 60 * 60
+RETENTION = 8 * 24 * 60 * 60
+# Seconds a process keeps its counters before writing them to Redis, override
+# with `shipping_metrics_flush_interval` in site config.
+DEFAULT_FLUSH_INTERVAL = 30
+
+# Counters and last flush time per site, a worker may serve several sites
+_counters = {}
+_counters_lock = threading.Lock()
+_last_flush = {}
+
+
+def record(provider: str, endpoint: str | None, duration: float, success: bool):
+	"""Count one provider call of `duration` seconds. Cheap enough to call on every request."""
+	site = frappe.local.site
+	key = (int(time.time() // WINDOW), provider, endpoint or "other")
+	bucket = bisect_left(LATENCY_BUCKETS, duration * 1000)
+	with _counters_lock:
+		site_counters = _counters.setdefault(site, {})
+		_last_flush.setdefault(site, time.monotonic())
+		counters = site_counters.get(key)
+		if counters is None:
+			counters = site_counters[key] = {"count": 0, "errors": 0, "total_ms": 0}
+		counters["count"] += 1
+		counters["total_ms"] += round(duration * 1000)
+		counters[f"b{bucket}"] = counters.get(f"b{bucket}", 0) + 1
+		if not success:
+			counters["errors"] += 1
+
+	flush_if_due()
+
+
+def flush_if_due(*args, **kwargs):
+	"""Write the counters to Redis if the flush interval has passed. Also used as request and job hook."""
+	site = getattr(frappe.local, "site", None)
+	if _counters.get(site) and time.monotonic() - _last_flush[site] >= get_flush_interval():
+		flush()
+
+
+def flush():
+	"""Add the counters of this process for the current site to its hourly counters in Redis.
+
+	Counters of other sites stay in memory until a request or job of that site
+	flushes them, so that they end up in that site's cache.
+	"""
+	site = frappe.local.site
+	with _counters_lock:
+		counters = _counters.pop(site, None)
+		_last_flush[site] = time.monotonic()
+
+	if not counters:
+		return
+
+	try:
+		cache = frappe.cache()
+		index_key = cache.make_key(METRICS_KEY)
+		pipeline = cache.pipeline()
+		for (window, provider, endpoint), values in counters.items():
+			member = f"{window}::{provider}::{endpoint}"
+			key = cache.make_key(f"{METRICS_KEY}::{member}")
+			for field, value in values.items():
+				pipeline.hincrby(key, field, value)
+			pipeline.expire(key, RETENTION)
+			pipeline.sadd(index_key, member)
+
+		pipeline.expire(index_key, RETENTION)
+		pipeline.execute()
+	except Exception:
+		# metrics must never break a provider call
+		frappe.log_error(title="Shipping Metrics Error")
+
+
+def get_metrics(since: float, provider: str | None = None) -> list[dict]:
+	"""Return the aggregated metrics per provider and endpoint of all hours since `since`."""
+	cache = frappe.cache()
+	first_window = int(since // WINDOW)
+	members = []
+	# the wrapper adds the site prefix that `flush` adds through `make_key`
+	for member in cache.smembers(METRICS_KEY):
+		member = frappe.safe_decode(member)
+		window, member_provider, _endpoint = member.split("::", 2)
+		if int(window) >= first_window and (not provider or member_provider == provider):
+			members.append(member)
+
+	pipeline = cache.pipeline()
+	for member in members:
+		pipeline.hgetall(cache.make_key(f"{METRICS_KEY}::{member}"))
+
+	totals = {}
+	for member, values in zip(members, pipeline.execute()):
+		_window, member_provider, endpoint = member.split("::", 2)
+		total = totals.setdefault((member_provider, endpoint), {})
+		for field, value in values.items():
+			field = frappe.safe_decode(field)
+			total[field] = total.get(field, 0) + int(value)
+
+	metrics = []
+	for (member_provider, endpoint), total in sorted(totals.items()):
+		count = total.get("count", 0)
+		if not count:
+			continue
+
+		buckets = [total.get(f"b{idx}", 0) for idx in range(len(LATENCY_BUCKETS) + 1)]
+		metrics.append(
+			frappe._dict(
+				provider=member_provider,
+				endpoint=endpoint,
+				calls=count,
+				errors=total.get("errors", 0),
+				error_rate=100 * total.get("errors", 0) / count,
+				avg=total.get("total_ms", 0) / count,
+				p50=get_percentile(buckets, 0.5),
+				p95=get_percentile(buckets, 0.95),
+				p99=get_percentile(buckets, 0.99),
+			)
+		)
+
+	return metrics
+
+
+def get_percentile(buckets: list[int], quantile: float) -> float:
+	"""Estimate a latency percentile in milliseconds, interpolating within its bucket."""
+	rank = quantile * sum(buckets)
+	seen = 0
+	for idx, count in enumerate(buckets):
+		if count and seen + count >= rank:
+			lower = LATENCY_BUCKETS[idx - 1] if idx else 0
+			# calls slower than the last bound are reported as that bound
+			upper = LATENCY_BUCKETS[idx] if idx < len(LATENCY_BUCKETS) else lower
+			return lower + (upper - lower) * (rank - seen) / count
+		seen += count
+
+	return 0
+
+
+def get_flush_interval() -> int:
+	return frappe.conf.get("shipping_metrics_flush_interval") or DEFAULT_FLUSH_INTERVAL
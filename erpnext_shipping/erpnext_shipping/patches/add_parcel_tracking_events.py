@@ -0,0 +1,16 @@
+import frappe
+from frappe.utils import create_batch
+
+from erpnext_shipping.erpnext_shipping.tracking import TRACKING_FIELDS, record_tracking_events
+
+
+def execute():
+	"""Record the parcels of booked multi parcel Shipments, so that webhooks can find them."""
+	frappe.reload_doc("erpnext_shipping", "doctype", "shipment_tracking_event")
+	shipments = frappe.get_all(
+		"Shipment",
+		filters={"docstatus": 1, "status": "Booked", "shipment_id": ["like", "%, %"]},
+		fields=["name", "shipment_id", *TRACKING_FIELDS],
+	)
+	for batch in create_batch(shipments, 500):
+		record_tracking_events({shipment.name: (shipment.shipment_id, shipment) for shipment in batch})
@@ -0,0 +1,14 @@
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+from erpnext_shipping.install import add_shipment_polling_index
+
+
+def execute():
+	"""Add the fields and index of the per-Shipment tracking schedule.
+
+	Shipments booked before have no `next_poll_at` yet, the daily sweep
+	polls them once and schedules them from then on.
+	"""
+	create_custom_fields(frappe.get_hooks("shipping_custom_fields"))
+	add_shipment_polling_index()
@@ -0,0 +1,6 @@
+from erpnext_shipping.install import add_shipment_indexes
+
+
+def execute():
+	"""Index the Shipment columns that incoming tracking updates are matched on."""
+	add_shipment_indexes()
@@ -0,0 +1,193 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+import copy
+import hashlib
+import json
+import time
+from bisect import insort
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import frappe
+from frappe import _
+from frappe.utils import flt, getdate
+
+from erpnext_shipping.erpnext_shipping import circuit_breaker
+from erpnext_shipping.erpnext_shipping.concurrency import SiteThreadPoolExecutor
+from erpnext_shipping.erpnext_shipping.utils import match_parcel_service_type_carrier, show_error_alert
+
+# Seconds the user waits for all providers together, override with
+# `shipping_rate_timeout` in site config. Single providers can be given a
+# shorter deadline with `shipping_provider_timeouts`, e.g. {"LetMeShip": 8}.
+DEFAULT_RATE_TIMEOUT = 20
+
+RATE_CACHE_KEY = "shipping_rates"
+# Seconds a complete set of quotes is reused for an identical shipment,
+# override with `shipping_rate_cache_ttl` in site config.
+DEFAULT_RATE_CACHE_TTL = 10 * 60
+
+
+def get_rate_providers() -> dict:
+	"""Return {provider: method} for all registered rate providers.
+
+	Providers are registered via the `shipping_rate_providers` hook. The key is
+	the name of the provider's Single settings DocType, the value the dotted
+	path to a function that takes a rate request and returns a list of rates.
+	"""
+	return {
+		provider: frappe.get_attr(methods[-1])
+		for provider, methods in frappe.get_hooks("shipping_rate_providers").items()
+	}
+
+
+def get_enabled_rate_providers() -> dict:
+	return {
+		provider: method
+		for provider, method in get_rate_providers().items()
+		if frappe.db.get_single_value(provider, "enabled")
+	}
+
+
+def get_rate_timeout(provider: str | None = None) -> float:
+	budget = frappe.conf.get("shipping_rate_timeout") or DEFAULT_RATE_TIMEOUT
+	if provider:
+		provider_timeout = (frappe.conf.get("shipping_provider_timeouts") or {}).get(provider)
+		if provider_timeout:
+			return min(provider_timeout, budget)
+
+	return budget
+
+
+def get_cached_shipping_rates(rate_request, on_result=None) -> frappe._dict:
+	"""Return rates for the rate request, reusing the quotes of an identical shipment.
+
+	The result and `on_result` work like the ones of `get_shipping_rates`. Cached
+	rates are passed to `on_result` at once, with `None` as provider.
+	"""
+	shipment_prices = get_cached_rates(rate_request)
+	if shipment_prices is not None:
+		if on_result:
+			on_result(None, shipment_prices)
+		return frappe._dict(rates=shipment_prices, skipped_providers=[])
+
+	result = get_shipping_rates(rate_request, on_result=on_result)
+	# partial results are not cached, the next request should ask the skipped providers again
+	if result.rates and not result.skipped_providers:
+		frappe.cache().set_value(
+			get_rate_cache_key(rate_request),
+			result.rates,
+			expires_in_sec=frappe.conf.get("shipping_rate_cache_ttl") or DEFAULT_RATE_CACHE_TTL,
+		)
+
+	return result
+
+
+def get_cached_rates(rate_request) -> list[dict] | None:
+	"""Return the cached quotes of an identical shipment, or None."""
+	return frappe.cache().get_value(get_rate_cache_key(rate_request))
+
+
+def get_rate_cache_key(rate_request) -> str:
+	"""Return a cache key built from everything that drives the price of a shipment."""
+	fingerprint = {
+		"pickup_from_type": rate_request.pickup_from_type,
+		"pickup": [rate_request.pickup_address.country_code, rate_request.pickup_address.pincode],
+		"delivery": [rate_request.delivery_address.country_code, rate_request.delivery_address.pincode],
+		"parcels": sorted(
+			[flt(parcel.get(field)) for field in ("length", "width", "height", "weight", "count")]
+			for parcel in rate_request.parcels
+		),
+		"value_of_goods": flt(rate_request.value_of_goods),
+		"pickup_date": str(getdate(rate_request.pickup_date)),
+	}
+	digest = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+	return f"{RATE_CACHE_KEY}::{digest}"
+
+
+def clear_rate_cache(rate_request=None):
+	"""Clear the cached quotes for one rate request, or all of them."""
+	if rate_request:
+		frappe.cache().delete_value(get_rate_cache_key(rate_request))
+	else:
+		frappe.cache().delete_keys(RATE_CACHE_KEY)
+
+
+def get_shipping_rates(rate_request, on_result=None) -> frappe._dict:
+	"""Query all enabled providers at the same time and return their rates sorted by price.
+
+	Every provider gets its own copy of the rate request and its own deadline.
+	Providers that fail, miss their deadline or whose circuit is open are
+	skipped and listed in `skipped_providers`, the others' rates are kept.
+	`on_result` is called with the provider name and its annotated rates as
+	soon as they arrive.
+	"""
+	result = frappe._dict(rates=[], skipped_providers=[])
+	providers = {}
+	for provider, method in get_enabled_rate_providers().items():
+		if circuit_breaker.is_open(provider):
+			skip_provider(result, provider, _("{0} is currently unavailable and was skipped."))
+		else:
+			providers[provider] = method
+
+	if not providers:
+		return result
+
+	shipment_prices = result.rates
+	executor = SiteThreadPoolExecutor(max_workers=len(providers))
+	start = time.monotonic()
+	pending = {
+		executor.submit(get_provider_rates, method, copy.deepcopy(rate_request)): (
+			provider,
+			start + get_rate_timeout(provider),
+		)
+		for provider, method in providers.items()
+	}
+
+	try:
+		while pending:
+			next_deadline = min(deadline for _provider, deadline in pending.values())
+			done, _not_done = wait(
+				pending, timeout=max(next_deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED
+			)
+
+			for future in done:
+				provider, _deadline = pending.pop(future)
+				try:
+					prices = future.result()
+				except circuit_breaker.ProviderUnavailableError:
+					# another request is probing the provider, the exception already told the user
+					skip_provider(result, provider)
+					continue
+				except Exception:
+					show_error_alert(f"fetching {provider} prices")
+					skip_provider(result, provider)
+					continue
+
+				for price in prices:
+					insort(shipment_prices, price, key=lambda k: k["total_price"])
+
+				if on_result:
+					on_result(provider, prices)
+
+			now = time.monotonic()
+			for future, (provider, deadline) in list(pending.items()):
+				if deadline <= now:
+					pending.pop(future)
+					future.cancel()
+					circuit_breaker.record_failure(provider)
+					skip_provider(result, provider, _("{0} did not respond in time and was skipped."))
+	finally:
+		# only providers that timed out are still running, don't wait for those
+		executor.shutdown(wait=not pending, cancel_futures=True)
+
+	return result
+
+
+def skip_provider(result, provider: str, message: str | None = None):
+	result.skipped_providers.append(provider)
+	if message:
+		frappe.msgprint(message.format(provider), indicator="orange", alert=True)
+
+
+def get_provider_rates(method, rate_request) -> list[dict]:
+	prices = method(rate_request) or []
+	return match_parcel_service_type_carrier(prices, "carrier", "service_name")
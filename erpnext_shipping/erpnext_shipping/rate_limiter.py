@@ -0,0 +1,162 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+"""Token buckets in Redis that all workers share, one per provider account.
+
+Interactive calls (quotes, bookings, labels) may empty the bucket. Background
+calls (tracking, catalog refreshes) leave a reserve for them, so they use the
+remaining headroom without starving the UI. A `429` response blocks the bucket
+for the `Retry-After` period and halves its rate, which then recovers over time.
+"""
+
+import asyncio
+import hashlib
+import time
+from email.utils import parsedate_to_datetime
+
+import frappe
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+RATE_LIMIT_KEY = "shipping_rate_limit"
+# Requests per second and bucket size per provider account, override with
+# `shipping_rate_limits` in site config, e.g. {"SendCloud": {"rate": 5, "burst": 10}}.
+DEFAULT_RATE = 10
+DEFAULT_BURST = 20
+# Share of the bucket that background calls leave for interactive ones
+BACKGROUND_RESERVE = 0.25
+# Seconds a call waits for a token before it is sent anyway
+MAX_WAIT = {INTERACTIVE: 10, BACKGROUND: 5 * 60}
+# Used when a 429 response has no Retry-After header
+DEFAULT_RETRY_AFTER = 5
+MIN_RATE_FACTOR = 0.1
+# Share of the full rate regained per second after a 429
+RATE_RECOVERY = 0.01
+
+# Returns the seconds to wait for a token, or 0 if a token was taken
+ACQUIRE_SCRIPT = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local reserve, recovery = tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated_at", "factor", "blocked_until")
+local tokens = tonumber(state[1]) or burst
+local updated_at = tonumber(state[2]) or now
+local factor = tonumber(state[3]) or 1
+local blocked_until = tonumber(state[4]) or 0
+
+local elapsed = math.max(now - updated_at, 0)
+factor = math.min(1, factor + recovery * elapsed)
+tokens = math.min(burst, tokens + elapsed * rate * factor)
+
+local wait = 0
+if blocked_until > now then
+	wait = blocked_until - now
+elseif tokens >= 1 + reserve then
+	tokens = tokens - 1
+else
+	wait = (1 + reserve - tokens) / (rate * factor)
+end
+
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated_at", now, "factor", factor)
+redis.call("EXPIRE", KEYS[1], 3600)
+return tostring(wait)
+"""
+
+THROTTLE_SCRIPT = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local retry_after, min_factor = tonumber(ARGV[1]), tonumber(ARGV[2])
+local state = redis.call("HMGET", KEYS[1], "factor", "blocked_until")
+local factor = math.max(min_factor, (tonumber(state[1]) or 1) / 2)
+local blocked_until = math.max(tonumber(state[2]) or 0, now + retry_after)
+redis.call("HSET", KEYS[1], "tokens", 0, "updated_at", blocked_until, "factor", factor)
+redis.call("HSET", KEYS[1], "blocked_until", blocked_until)
+redis.call("EXPIRE", KEYS[1], 3600)
+return 1
+"""
+
+
+def acquire(provider: str, account: str | None, priority: str = INTERACTIVE):
+	"""Wait until the provider account has a token for this call."""
+	deadline = time.monotonic() + MAX_WAIT[priority]
+	while True:
+		wait = get_wait(provider, account, priority)
+		if not wait or time.monotonic() + wait > deadline:
+			return
+
+		time.sleep(wait)
+
+
+async def acquire_async(provider: str, account: str | None, priority: str = INTERACTIVE):
+	"""Like `acquire`, without blocking the event loop while waiting."""
+	deadline = time.monotonic() + MAX_WAIT[priority]
+	while True:
+		wait = get_wait(provider, account, priority)
+		if not wait or time.monotonic() + wait > deadline:
+			return
+
+		await asyncio.sleep(wait)
+
+
+def get_wait(provider: str, account: str | None, priority: str) -> float:
+	"""Take a token and return 0, or return the seconds until one is available."""
+	rate, burst = get_limits(provider)
+	reserve = burst * BACKGROUND_RESERVE if priority == BACKGROUND else 0
+	try:
+		cache = frappe.cache()
+		wait = cache.eval(
+			ACQUIRE_SCRIPT, 1, get_bucket_key(provider, account), rate, burst, reserve, RATE_RECOVERY
+		)
+	except Exception:
+		# without Redis, calls are not limited rather than not sent
+		return 0
+
+	return float(wait)
+
+
+def throttle(provider: str, account: str | None, retry_after: str | None = None):
+	"""Block the provider account after a 429 response and halve its rate."""
+	try:
+		cache = frappe.cache()
+		cache.eval(
+			THROTTLE_SCRIPT,
+			1,
+			get_bucket_key(provider, account),
+			parse_retry_after(retry_after),
+			MIN_RATE_FACTOR,
+		)
+	except Exception:
+		frappe.log_error(title="Shipping Rate Limit Error")
+
+
+def parse_retry_after(retry_after: str | None) -> float:
+	"""Return the seconds of a Retry-After header, which holds seconds or an HTTP date."""
+	if not retry_after:
+		return DEFAULT_RETRY_AFTER
+
+	try:
+		return max(float(retry_after), 0)
+	except ValueError:
+		pass
+
+	try:
+		return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+	except (TypeError, ValueError):
+		return DEFAULT_RETRY_AFTER
+
+
+def get_limits(provider: str) -> tuple[float, float]:
+	limits = (frappe.conf.get("shipping_rate_limits") or {}).get(provider) or {}
+	return limits.get("rate") or DEFAULT_RATE, limits.get("burst") or DEFAULT_BURST
+
+
+def get_account(auth) -> str | None:
+	"""Return the account of a `(user, password)` auth tuple."""
+	return auth[0] if isinstance(auth, tuple | list) and auth else None
+
+
+def get_bucket_key(provider: str, account: str | None) -> str:
+	# the account is an API key, keep it out of the key names
+	account_hash = hashlib.sha256((account or "").encode()).hexdigest()[:16]
+	return frappe.cache().make_key(f"{RATE_LIMIT_KEY}::{provider}::{account_hash}")
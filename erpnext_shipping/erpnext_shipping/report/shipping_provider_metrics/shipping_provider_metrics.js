@@ -0,0 +1,21 @@
+// Copyright (c) 2024, Frappe and contributors
+// For license information, please see license.txt
+
+frappe.query_reports["Shipping Provider Metrics"] = {
+	filters: [
+		{
+			fieldname: "period",
+			label: __("Period"),
+			fieldtype: "Select",
+			options: ["Last Hour", "Last 24 Hours", "Last 7 Days"],
+			default: "Last 24 Hours",
+			reqd: 1,
+		},
+		{
+			fieldname: "provider",
+			label: __("Provider"),
+			fieldtype: "Select",
+			options: ["", "LetMeShip", "SendCloud"],
+		},
+	],
+};
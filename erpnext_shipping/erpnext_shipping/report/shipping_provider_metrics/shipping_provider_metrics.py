@@ -0,0 +1,35 @@
+# Copyright (c) 2024, Frappe and contributors
+# For license information, please see license.txt
+import time
+
+import frappe
+from frappe import _
+
+from erpnext_shipping.erpnext_shipping.metrics import flush, get_metrics
+
+PERIODS = {"Last Hour": 60 * 60, "Last 24 Hours": 24 * 60 * 60, "Last 7 Days": 7 * 24 * 60 * 60}
+
+
+def execute(filters=None):
+	filters = frappe._dict(filters or {})
+	# include the calls of this process that have not been written yet
+	flush()
+	data = get_metrics(
+		since=time.time() - PERIODS.get(filters.period, PERIODS["Last 24 Hours"]),
+		provider=filters.provider,
+	)
+	return get_columns(), data
+
+
+def get_columns():
+	return [
+		{"fieldname": "provider", "label": _("Provider"), "fieldtype": "Data", "width": 120},
+		{"fieldname": "endpoint", "label": _("Endpoint"), "fieldtype": "Data", "width": 140},
+		{"fieldname": "calls", "label": _("Calls"), "fieldtype": "Int", "width": 90},
+		{"fieldname": "errors", "label": _("Errors"), "fieldtype": "Int", "width": 90},
+		{"fieldname": "error_rate", "label": _("Error Rate (%)"), "fieldtype": "Percent", "width": 120},
+		{"fieldname": "avg", "label": _("Average (ms)"), "fieldtype": "Float", "precision": 0, "width": 120},
+		{"fieldname": "p50", "label": _("p50 (ms)"), "fieldtype": "Float", "precision": 0, "width": 100},
+		{"fieldname": "p95", "label": _("p95 (ms)"), "fieldtype": "Float", "precision": 0, "width": 100},
+		{"fieldname": "p99", "label": _("p99 (ms)"), "fieldtype": "Float", "precision": 0, "width": 100},
+	]
@@ -1,16 +1,31 @@
 # Copyright (c) 2020, Frappe Technologies and contributors
 # For license information, please see license.txt
 import json
+import tempfile
 
 import frappe
-from erpnext.stock.doctype.shipment.shipment import get_company_contact
+from frappe import _
 
+from erpnext_shipping.erpnext_shipping import rate_limiter
 from erpnext_shipping.erpnext_shipping.doctype.letmeship.letmeship import LETMESHIP_PROVIDER, get_letmeship_utils
 from erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud import SENDCLOUD_PROVIDER, SendCloudUtils
+from erpnext_shipping.erpnext_shipping.providers import (
+	clear_rate_cache,
+	get_cached_rates,
+	get_cached_shipping_rates,
+	get_enabled_rate_providers,
+)
+from erpnext_shipping.erpnext_shipping.tracking import (
+	get_poll_values,
+	record_tracking_events,
+	schedule_awb_lookup,
+	update_tracking_for_shipments,
+)
 from erpnext_shipping.erpnext_shipping.utils import (
+	DocumentWriteBuffer,
 	get_address,
-	get_contact,
-	match_parcel_service_type_carrier,
+	get_shipment_contacts,
+	merge_pdfs,
 )
 
 
@@ -28,59 +43,113 @@ def fetch_shipping_rates(
 	delivery_contact_name=None,
 ):
 	# Return Shipping Rates for the various Shipping Providers
-	shipment_prices = []
-	letmeship_enabled = frappe.db.get_single_value("LetMeShip", "enabled")
-	sendcloud_enabled = frappe.db.get_single_value("SendCloud", "enabled")
-	pickup_address = get_address(pickup_address_name)
-	delivery_address = get_address(delivery_address_name)
-	parcels = json.loads(parcels)
-
-	if letmeship_enabled:
-		pickup_contact = None
-		delivery_contact = None
-		if pickup_from_type != "Company":
-			pickup_contact = get_contact(pickup_contact_name)
-		else:
-			pickup_contact = get_company_contact(user=pickup_contact_name)
-			pickup_contact.email_id = pickup_contact.pop("email", None)
-
-		if delivery_to_type != "Company":
-			delivery_contact = get_contact(delivery_contact_name)
-		else:
-			delivery_contact = get_company_contact(user=pickup_contact_name)
-			delivery_contact.email_id = delivery_contact.pop("email", None)
+	rate_request = get_rate_request(
+		pickup_from_type,
+		delivery_to_type,
+		pickup_address_name,
+		delivery_address_name,
+		parcels,
+		description_of_content,
+		pickup_date,
+		value_of_goods,
+		pickup_contact_name,
+		delivery_contact_name,
+	)
+	result = get_cached_shipping_rates(rate_request)
+	# the rates stay the return value, so that existing callers keep working
+	frappe.response["skipped_providers"] = result.skipped_providers
+	return result.rates
 
-		letmeship = get_letmeship_utils()
-		letmeship_prices = (
-			letmeship.get_available_services(
-				delivery_to_type=delivery_to_type,
-				pickup_address=pickup_address,
-				delivery_address=delivery_address,
-				parcels=parcels,
-				description_of_content=description_of_content,
-				pickup_date=pickup_date,
-				value_of_goods=value_of_goods,
-				pickup_contact=pickup_contact,
-				delivery_contact=delivery_contact,
-			)
-			or []
-		)
-		letmeship_prices = match_parcel_service_type_carrier(letmeship_prices, "carrier", "service_name")
-		shipment_prices += letmeship_prices
 
-	if sendcloud_enabled and pickup_from_type == "Company":
-		sendcloud = SendCloudUtils()
-		sendcloud_prices = (
-			sendcloud.get_available_services(
-				delivery_address=delivery_address, parcels=parcels
-			)
-			or []
+@frappe.whitelist()
+def start_shipping_rate_quote(
+	quote_id,
+	pickup_from_type,
+	delivery_to_type,
+	pickup_address_name,
+	delivery_address_name,
+	parcels,
+	description_of_content,
+	pickup_date,
+	value_of_goods,
+	pickup_contact_name=None,
+	delivery_contact_name=None,
+):
+	"""Fetch Shipping Rates in the background and publish every provider's rates as they arrive.
+
+	The rates are sent to the user as `shipping_rates` realtime events, tagged
+	with `quote_id`. The last event has `done` set and lists the skipped providers.
+	Cached rates are returned at once in the same form, without a background job.
+	"""
+	rate_request = get_rate_request(
+		pickup_from_type,
+		delivery_to_type,
+		pickup_address_name,
+		delivery_address_name,
+		parcels,
+		description_of_content,
+		pickup_date,
+		value_of_goods,
+		pickup_contact_name,
+		delivery_contact_name,
+	)
+	rates = get_cached_rates(rate_request)
+	if rates is not None:
+		return {"quote_id": quote_id, "rates": rates, "done": True, "skipped_providers": []}
+
+	frappe.enqueue(
+		"erpnext_shipping.erpnext_shipping.shipping.run_shipping_rate_quote",
+		queue="short",
+		quote_id=quote_id,
+		rate_request=rate_request,
+		user=frappe.session.user,
+	)
+
+
+def run_shipping_rate_quote(quote_id: str, rate_request, user: str):
+	def publish_rates(provider, rates):
+		frappe.publish_realtime(
+			"shipping_rates", {"quote_id": quote_id, "provider": provider, "rates": rates}, user=user
 		)
-		sendcloud_prices = match_parcel_service_type_carrier(sendcloud_prices, "carrier", "service_name")
-		shipment_prices += sendcloud_prices
 
-	shipment_prices = sorted(shipment_prices, key=lambda k: k["total_price"])
-	return shipment_prices
+	try:
+		result = get_cached_shipping_rates(rate_request, on_result=publish_rates)
+		skipped_providers = result.skipped_providers
+	except Exception:
+		frappe.log_error(title="Shipping Error")
+		skipped_providers = list(get_enabled_rate_providers())
+
+	frappe.publish_realtime(
+		"shipping_rates",
+		{"quote_id": quote_id, "done": True, "skipped_providers": skipped_providers},
+		user=user,
+	)
+
+
+def get_rate_request(
+	pickup_from_type,
+	delivery_to_type,
+	pickup_address_name,
+	delivery_address_name,
+	parcels,
+	description_of_content,
+	pickup_date,
+	value_of_goods,
+	pickup_contact_name=None,
+	delivery_contact_name=None,
+) -> frappe._dict:
+	return frappe._dict(
+		pickup_from_type=pickup_from_type,
+		delivery_to_type=delivery_to_type,
+		pickup_address=get_address(pickup_address_name),
+		delivery_address=get_address(delivery_address_name),
+		parcels=json.loads(parcels),
+		description_of_content=description_of_content,
+		pickup_date=pickup_date,
+		value_of_goods=value_of_goods,
+		pickup_contact_name=pickup_contact_name,
+		delivery_contact_name=delivery_contact_name,
+	)
 
 
 @frappe.whitelist()
@@ -106,22 +175,14 @@ def create_shipment(
 		delivery_notes = []
 
 	service_info = json.loads(service_data)
-	shipment_info, pickup_contact, delivery_contact = None, None, None
+	shipment_info = None
 	pickup_address = get_address(pickup_address_name)
 	delivery_address = get_address(delivery_address_name)
 	delivery_company_name = get_delivery_company_name(shipment)
 
-	if pickup_from_type != "Company":
-		pickup_contact = get_contact(pickup_contact_name)
-	else:
-		pickup_contact = get_company_contact(user=pickup_contact_name)
-		pickup_contact.email_id = pickup_contact.pop("email", None)
-
-	if delivery_to_type != "Company":
-		delivery_contact = get_contact(delivery_contact_name)
-	else:
-		delivery_contact = get_company_contact(user=pickup_contact_name)
-		pickup_contact.email_id = pickup_contact.pop("email", None)
+	pickup_contact, delivery_contact = get_shipment_contacts(
+		pickup_from_type, delivery_to_type, pickup_contact_name, delivery_contact_name
+	)
 
 	if service_info["service_provider"] == LETMESHIP_PROVIDER:
 		letmeship = get_letmeship_utils()
@@ -152,24 +213,54 @@ def create_shipment(
 		)
 
 	if shipment_info:
-		fields = [
-			"service_provider",
-			"carrier",
-			"carrier_service",
-			"shipment_id",
-			"shipment_amount",
-			"awb_number",
-		]
-		for field in fields:
-			frappe.db.set_value("Shipment", shipment, field, shipment_info.get(field))
-		frappe.db.set_value("Shipment", shipment, "status", "Booked")
-
-		if delivery_notes:
-			update_delivery_note(delivery_notes=delivery_notes, shipment_info=shipment_info)
+		update_booked_shipment(shipment, shipment_info, delivery_notes)
+		clear_rate_cache(
+			frappe._dict(
+				pickup_from_type=pickup_from_type,
+				pickup_address=pickup_address,
+				delivery_address=delivery_address,
+				parcels=json.loads(shipment_parcel),
+				value_of_goods=value_of_goods,
+				pickup_date=pickup_date,
+			)
+		)
 
 	return shipment_info
 
 
+def update_booked_shipment(shipment: str, shipment_info: dict, delivery_notes=None):
+	write_buffer = DocumentWriteBuffer()
+	fields = [
+		"service_provider",
+		"carrier",
+		"carrier_service",
+		"shipment_id",
+		"shipment_amount",
+		"awb_number",
+	]
+	write_buffer.set_value(
+		"Shipment",
+		shipment,
+		{
+			**{field: shipment_info.get(field) for field in fields},
+			**get_poll_values({}),
+			"status": "Booked",
+		},
+	)
+
+	if delivery_notes:
+		update_delivery_note(
+			delivery_notes=delivery_notes, shipment_info=shipment_info, write_buffer=write_buffer
+		)
+
+	write_buffer.flush()
+	# one event per parcel, so that webhooks find multi parcel Shipments by parcel id
+	record_tracking_events({shipment: (shipment_info.get("shipment_id"), shipment_info)})
+
+	# AWB number and tracking info are filled in by a background job
+	schedule_awb_lookup(shipment)
+
+
 def get_delivery_company_name(shipment: str) -> str | None:
 	shipment_doc = frappe.get_doc("Shipment", shipment)
 	if shipment_doc.delivery_customer:
@@ -184,23 +275,44 @@ def get_delivery_company_name(shipment: str) -> str | None:
 
 @frappe.whitelist()
 def print_shipping_label(shipment: str):
-	shipment_doc = frappe.get_doc("Shipment", shipment)
-	service_provider = shipment_doc.service_provider
-	shipment_id = shipment_doc.shipment_id
+	"""Store the label of a Shipment as attachment and return its URL."""
+	shipping_label = get_shipping_label(shipment)
+	if shipping_label:
+		return save_label_as_attachment(shipment, shipping_label)
+
+
+@frappe.whitelist(methods=["GET"])
+def download_shipping_label(shipment: str):
+	"""Respond with the label of a Shipment as PDF, without storing it."""
+	frappe.has_permission("Shipment", "read", shipment, throw=True)
+	shipping_label = get_shipping_label(shipment)
+	if not shipping_label:
+		frappe.throw(_("No label found for Shipment {0}").format(shipment), title=_("Label Not Found"))
+
+	frappe.local.response.filename = f"label_{shipment}.pdf"
+	frappe.local.response.filecontent = shipping_label
+	frappe.local.response.type = "pdf"
+
+
+def get_shipping_label(shipment: str) -> bytes | None:
+	"""Return the label PDF of a Shipment, all parcels merged into one."""
+	service_provider, shipment_id = frappe.db.get_value(
+		"Shipment", shipment, ["service_provider", "shipment_id"]
+	)
 
 	if service_provider == LETMESHIP_PROVIDER:
 		letmeship = get_letmeship_utils()
-		shipping_label = letmeship.get_label(shipment_id)
+		return letmeship.get_label(shipment_id)
 	elif service_provider == SENDCLOUD_PROVIDER:
 		sendcloud = SendCloudUtils()
-		shipping_label = []
-		_labels = sendcloud.get_label(shipment_id)
-		for label_url in _labels:
-			content = sendcloud.download_label(label_url)
-			file_url = save_label_as_attachment(shipment, content)
-			shipping_label.append(file_url)
+		label_urls = sendcloud.get_label(shipment_id)
+		if label_urls:
+			with tempfile.TemporaryDirectory() as tmp_dir:
+				label_paths = sendcloud.download_labels(label_urls, tmp_dir)
+				if label_paths:
+					return merge_pdfs(label_paths)
 
-	return shipping_label
+	return None
 
 
 def save_label_as_attachment(shipment: str, content: bytes) -> str:
@@ -219,44 +331,65 @@ def save_label_as_attachment(shipment: str, content: bytes) -> str:
 
 
 @frappe.whitelist()
-def update_tracking(shipment, service_provider, shipment_id, delivery_notes=None):
-	if delivery_notes is None:
-		delivery_notes = []
+def update_tracking(shipment, service_provider=None, shipment_id=None, delivery_notes=None):
+	"""Update the tracking info of a Shipment and its Delivery Notes now.
+
+	Goes through the same path as the scheduled updates, so changes are recorded
+	as Shipment Tracking Events and the next poll is rescheduled. Provider,
+	shipment id and Delivery Notes are read from the Shipment, the arguments are
+	only kept for backward compatibility.
+	"""
+	if not update_tracking_for_shipments([shipment], priority=rate_limiter.INTERACTIVE):
+		frappe.msgprint(
+			_("The tracking info of this Shipment is already being updated, please try again in a moment."),
+			indicator="orange",
+			alert=True,
+		)
 
-	# Update Tracking info in Shipment
-	tracking_data = None
-	if service_provider == LETMESHIP_PROVIDER:
-		letmeship = get_letmeship_utils()
-		tracking_data = letmeship.get_tracking_data(shipment_id)
-	elif service_provider == SENDCLOUD_PROVIDER:
-		sendcloud = SendCloudUtils()
-		tracking_data = sendcloud.get_tracking_data(shipment_id)
 
-	if tracking_data:
-		fields = ["awb_number", "tracking_status", "tracking_status_info", "tracking_url"]
-		for field in fields:
-			frappe.db.set_value("Shipment", shipment, field, tracking_data.get(field))
+def set_tracking_info(shipment: str, tracking_data: dict, delivery_notes=None, write_buffer=None):
+	"""Write the tracking info returned by a provider to the Shipment and its Delivery Notes."""
+	buffer = write_buffer or DocumentWriteBuffer()
+	fields = ["awb_number", "tracking_status", "tracking_status_info", "tracking_url"]
+	buffer.set_value("Shipment", shipment, {field: tracking_data.get(field) for field in fields})
 
-		if delivery_notes:
-			update_delivery_note(delivery_notes=delivery_notes, tracking_info=tracking_data)
+	if delivery_notes:
+		update_delivery_note(delivery_notes=delivery_notes, tracking_info=tracking_data, write_buffer=buffer)
 
+	if not write_buffer:
+		buffer.flush()
 
-def update_delivery_note(delivery_notes, shipment_info=None, tracking_info=None):
+
+def update_delivery_note(delivery_notes, shipment_info=None, tracking_info=None, write_buffer=None):
 	# Update Shipment Info in Delivery Note
-	# Using db_set since some services might not exist
+	# Using set_value since some services might not exist
 	if isinstance(delivery_notes, str):
 		delivery_notes = json.loads(delivery_notes)
 
-	delivery_notes = list(set(delivery_notes))
-
-	for delivery_note in delivery_notes:
-		dl_doc = frappe.get_doc("Delivery Note", delivery_note)
-		if shipment_info:
-			dl_doc.db_set("delivery_type", "Parcel Service")
-			dl_doc.db_set("parcel_service", shipment_info.get("carrier"))
-			dl_doc.db_set("parcel_service_type", shipment_info.get("carrier_service"))
-		if tracking_info:
-			dl_doc.db_set("tracking_number", tracking_info.get("awb_number"))
-			dl_doc.db_set("tracking_url", tracking_info.get("tracking_url"))
-			dl_doc.db_set("tracking_status", tracking_info.get("tracking_status"))
-			dl_doc.db_set("tracking_status_info", tracking_info.get("tracking_status_info"))
+	values = {}
+	if shipment_info:
+		values.update(
+			{
+				"delivery_type": "Parcel Service",
+				"parcel_service": shipment_info.get("carrier"),
+				"parcel_service_type": shipment_info.get("carrier_service"),
+			}
+		)
+	if tracking_info:
+		values.update(
+			{
+				"tracking_number": tracking_info.get("awb_number"),
+				"tracking_url": tracking_info.get("tracking_url"),
+				"tracking_status": tracking_info.get("tracking_status"),
+				"tracking_status_info": tracking_info.get("tracking_status_info"),
+			}
+		)
+	if not values:
+		return
+
+	buffer = write_buffer or DocumentWriteBuffer()
+	for delivery_note in set(delivery_notes):
+		buffer.set_value("Delivery Note", delivery_note, values)
+
+	if not write_buffer:
+		buffer.flush()
@@ -0,0 +1,40 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+import time
+import unittest
+
+import frappe
+
+from erpnext_shipping.erpnext_shipping.metrics import LATENCY_BUCKETS, WINDOW, flush, get_metrics, record
+
+
+class TestMetrics(unittest.TestCase):
+	def test_round_trip(self):
+		provider = f"Test Provider {frappe.generate_hash(length=8)}"
+		record(provider, "available", 0.02, success=True)
+		record(provider, "available", 0.2, success=False)
+		record(provider, None, 90, success=True)
+		flush()
+
+		metrics = get_metrics(time.time() - WINDOW, provider=provider)
+		self.assertEqual(
+			[(row.provider, row.endpoint) for row in metrics], [(provider, "available"), (provider, "other")]
+		)
+
+		available, other = metrics
+		self.assertEqual(available.calls, 2)
+		self.assertEqual(available.errors, 1)
+		self.assertEqual(available.error_rate, 50)
+		self.assertEqual(available.avg, 110)
+		self.assertEqual(other.calls, 1)
+		self.assertEqual(other.errors, 0)
+		# slower than the last bucket
+		self.assertEqual(other.p99, LATENCY_BUCKETS[-1])
+
+	def test_other_providers_are_filtered(self):
+		provider = f"Test Provider {frappe.generate_hash(length=8)}"
+		record(provider, "tracking", 0.05, success=True)
+		flush()
+
+		self.assertFalse(get_metrics(time.time() - WINDOW, provider=f"{provider} Other"))
+		self.assertIn(provider, {row.provider for row in get_metrics(time.time() - WINDOW)})
@@ -0,0 +1,137 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from erpnext_shipping.erpnext_shipping.tracking import (
+	DELIVERED,
+	MAX_POLL_BACKOFF,
+	MAX_POLL_INTERVAL,
+	POLL_INTERVALS,
+	get_content_hash,
+	get_poll_state,
+	get_poll_values,
+	split_parcel_tracking_info,
+)
+
+NOW = datetime(2024, 6, 3, 12, 0)
+
+
+class TestTracking(unittest.TestCase):
+	def test_poll_state(self):
+		cases = [
+			({}, "booked"),
+			({"tracking_status": "", "awb_number": "JVGL0123"}, "booked"),
+			({"tracking_status": "In Transit", "tracking_status_info": "Sorted at hub"}, "in_transit"),
+			({"tracking_status": "In Transit", "tracking_status_info": "Out for delivery"}, "near_delivery"),
+			({"tracking_status": "In Transit", "tracking_status_info": "ready_for_pickup"}, "near_delivery"),
+			({"tracking_status": "Returned", "tracking_status_info": ""}, "exception"),
+			({"tracking_status": "In Transit", "tracking_status_info": "Delivery failed"}, "exception"),
+			({"tracking_status": "Delivered", "tracking_status_info": "Signed by J. Doe"}, DELIVERED),
+		]
+		for tracking_info, state in cases:
+			with self.subTest(tracking_info=tracking_info):
+				self.assertEqual(get_poll_state(tracking_info), state)
+
+	def test_poll_state_of_multi_parcel_shipments(self):
+		cases = [
+			("Delivered, In Transit", "in_transit"),
+			("In Transit, Delivered", "in_transit"),
+			("Delivered, Returned", "exception"),
+			("Delivered, Delivered", DELIVERED),
+			("Delivered, Delivered, Delivered", DELIVERED),
+		]
+		for tracking_status, state in cases:
+			with self.subTest(tracking_status=tracking_status):
+				self.assertEqual(get_poll_state({"tracking_status": tracking_status}), state)
+
+	@patch("erpnext_shipping.erpnext_shipping.tracking.now_datetime", return_value=NOW)
+	def test_poll_values(self, _):
+		self.assertEqual(
+			get_poll_values({"tracking_status": "In Transit"}),
+			{
+				"poll_state": "in_transit",
+				"next_poll_at": NOW + timedelta(seconds=POLL_INTERVALS["in_transit"]),
+				"poll_backoff": 0,
+			},
+		)
+
+		# every unchanged poll doubles the interval
+		values = get_poll_values({}, backoff=2)
+		self.assertEqual(values["poll_backoff"], 2)
+		self.assertEqual(values["next_poll_at"], NOW + timedelta(seconds=4 * POLL_INTERVALS["booked"]))
+
+		# up to the maximum
+		values = get_poll_values({"tracking_status": "Returned"}, backoff=MAX_POLL_BACKOFF + 5)
+		self.assertEqual(values["poll_backoff"], MAX_POLL_BACKOFF)
+		self.assertEqual(values["next_poll_at"], NOW + timedelta(seconds=MAX_POLL_INTERVAL))
+
+	@patch("erpnext_shipping.erpnext_shipping.tracking.now_datetime", return_value=NOW)
+	def test_delivered_shipments_are_not_polled(self, _):
+		for tracking_status in ("Delivered", "Delivered, Delivered"):
+			with self.subTest(tracking_status=tracking_status):
+				self.assertEqual(
+					get_poll_values({"tracking_status": tracking_status}, backoff=3),
+					{"poll_state": DELIVERED, "next_poll_at": None, "poll_backoff": 0},
+				)
+
+		# a partially delivered Shipment is still polled
+		values = get_poll_values({"tracking_status": "Delivered, Out for Delivery"})
+		self.assertEqual(values["poll_state"], "near_delivery")
+		self.assertEqual(values["next_poll_at"], NOW + timedelta(seconds=POLL_INTERVALS["near_delivery"]))
+
+	def test_split_parcel_tracking_info(self):
+		tracking_info = {
+			"awb_number": "JVGL01, JVGL02",
+			"tracking_status": "Delivered, In Transit",
+			"tracking_status_info": "Delivered, Sorted",
+			"tracking_url": "https://track.invalid/1, https://track.invalid/2",
+		}
+		self.assertEqual(
+			split_parcel_tracking_info("1001, 1002", tracking_info),
+			[
+				{
+					"parcel_id": "1001",
+					"awb_number": "JVGL01",
+					"tracking_status": "Delivered",
+					"tracking_status_info": "Delivered",
+					"tracking_url": "https://track.invalid/1",
+				},
+				{
+					"parcel_id": "1002",
+					"awb_number": "JVGL02",
+					"tracking_status": "In Transit",
+					"tracking_status_info": "Sorted",
+					"tracking_url": "https://track.invalid/2",
+				},
+			],
+		)
+
+	def test_split_parcel_tracking_info_pads_missing_values(self):
+		parcels = split_parcel_tracking_info("1001, 1002, 1003", {"awb_number": "JVGL01, JVGL02"})
+		self.assertEqual([parcel["awb_number"] for parcel in parcels], ["JVGL01", "JVGL02", ""])
+		self.assertEqual([parcel["tracking_status"] for parcel in parcels], ["", "", ""])
+
+	def test_split_parcel_tracking_info_keeps_commas_of_single_parcels(self):
+		tracking_info = {"tracking_status": "In Transit", "tracking_status_info": "Arrived at hub, sorted"}
+		(parcel,) = split_parcel_tracking_info("1001", tracking_info)
+		self.assertEqual(parcel["parcel_id"], "1001")
+		self.assertEqual(parcel["tracking_status_info"], "Arrived at hub, sorted")
+
+	def test_content_hash(self):
+		tracking_info = {"awb_number": "JVGL01", "tracking_status": "In Transit", "tracking_url": None}
+		self.assertEqual(
+			get_content_hash(tracking_info), get_content_hash({**tracking_info, "name": "SHIP-1"})
+		)
+		self.assertEqual(
+			get_content_hash(tracking_info), get_content_hash({**tracking_info, "tracking_url": ""})
+		)
+		self.assertNotEqual(
+			get_content_hash(tracking_info),
+			get_content_hash({**tracking_info, "tracking_status": "Delivered"}),
+		)
+		# a value moving to another field is a change, too
+		self.assertNotEqual(
+			get_content_hash({"awb_number": "JVGL01"}), get_content_hash({"tracking_status": "JVGL01"})
+		)
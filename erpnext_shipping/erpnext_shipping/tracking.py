@@ -0,0 +1,497 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# For license information, please see license.txt
+import hashlib
+import time
+
+import frappe
+from frappe.utils import add_to_date, create_batch, now_datetime
+
+from erpnext_shipping.erpnext_shipping import rate_limiter
+from erpnext_shipping.erpnext_shipping.async_client import fetch_tracking_data, run_sync
+from erpnext_shipping.erpnext_shipping.utils import DocumentWriteBuffer
+
+TRACKING_FIELDS = ("awb_number", "tracking_status", "tracking_status_info", "tracking_url")
+# Columns of a Shipment that its tracking update reads
+SHIPMENT_FIELDS = ["name", "service_provider", "shipment_id", "poll_backoff", *TRACKING_FIELDS]
+# Columns written by `record_tracking_events`
+EVENT_FIELDS = [
+	"name",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"shipment",
+	"parcel_id",
+	*TRACKING_FIELDS,
+	"content_hash",
+]
+TRACKING_LOCK_KEY = "shipping_tracking_lock"
+# Shipments per background job, override with `shipping_tracking_batch_size`
+# in site config. Provider calls of a batch are bounded by
+# `shipping_async_concurrency`.
+DEFAULT_BATCH_SIZE = 200
+# Upper bound for one batch, also used as expiry of the per-shipment lock.
+BATCH_TIMEOUT = 30 * 60
+
+# Booked Shipments waiting for their AWB number, scored by their next attempt
+AWB_PENDING_KEY = "shipping_awb_pending"
+AWB_ATTEMPTS_KEY = "shipping_awb_attempts"
+MAX_AWB_ATTEMPTS = 10
+# Seconds before the second attempt, doubled for every further one
+AWB_RETRY_DELAY = 60
+MAX_AWB_RETRY_DELAY = 60 * 60
+
+# Name of the last Shipment the running sweep has updated, also its job id
+SWEEP_CHECKPOINT_KEY = "shipping_tracking_sweep"
+SWEEP_TIMEOUT = 4 * 60 * 60
+# An unfinished sweep is resumed within this time, otherwise the next one starts over
+SWEEP_CHECKPOINT_EXPIRY = 24 * 60 * 60
+
+# Seconds until the next poll of a Shipment, by the state of its tracking info.
+# Every poll that brings no change doubles the interval, up to MAX_POLL_INTERVAL.
+POLL_INTERVALS = {
+	# booked, but the carrier has no tracking info yet
+	"booked": 15 * 60,
+	"near_delivery": 30 * 60,
+	"in_transit": 2 * 60 * 60,
+	# returned, lost or stuck, rarely changes again
+	"exception": 6 * 60 * 60,
+}
+MAX_POLL_INTERVAL = 24 * 60 * 60
+# `poll_state` of Shipments that are not polled anymore
+DELIVERED = "delivered"
+MAX_POLL_BACKOFF = 10
+NEAR_DELIVERY_STATUSES = ("out for delivery", "driver en route", "at pickup point", "ready for pickup")
+EXCEPTION_STATUSES = ("returned", "lost", "exception", "unable", "failed", "cancel", "refused", "damaged")
+# Due Shipments enqueued per tick, override with `shipping_tracking_max_due` in site config.
+DEFAULT_MAX_DUE = 2000
+
+
+def enqueue_tracking_sweep():
+	"""Enqueue the sweep over all Shipments without a scheduled poll, unless it is already running."""
+	frappe.enqueue(
+		"erpnext_shipping.erpnext_shipping.tracking.run_tracking_sweep",
+		queue="long",
+		timeout=SWEEP_TIMEOUT,
+		job_id=SWEEP_CHECKPOINT_KEY,
+		deduplicate=True,
+	)
+
+
+def resume_tracking_sweep():
+	"""Enqueue the sweep again if its last run stopped before the end."""
+	cache = frappe.cache()
+	# raw `get` like `run_tracking_sweep`, the wrapper methods add the site prefix again
+	if cache.get(cache.make_key(SWEEP_CHECKPOINT_KEY)) is not None:
+		enqueue_tracking_sweep()
+
+
+def run_tracking_sweep():
+	"""Update the tracking info of all Shipments that are still on their way but not scheduled.
+
+	Shipments are processed one batch at a time, in the order of their names.
+	The name of the last processed Shipment is kept in Redis, so that a run that
+	was interrupted (worker restart, job timeout) continues after it.
+	"""
+	cache = frappe.cache()
+	checkpoint_key = cache.make_key(SWEEP_CHECKPOINT_KEY)
+	after = frappe.safe_decode(cache.get(checkpoint_key)) or None
+	for batch in get_sweep_batches(after):
+		update_tracking_for_rows(batch)
+		cache.set(checkpoint_key, batch[-1].name, ex=SWEEP_CHECKPOINT_EXPIRY)
+		# keep what was written so far if the job is stopped later
+		frappe.db.commit()
+
+	cache.delete(checkpoint_key)
+
+
+def get_sweep_batches(after: str | None = None):
+	"""Yield batches of unscheduled Shipments that are still on their way, ordered by name.
+
+	Each batch is read with a keyset query (`name > last name`) of only the
+	columns the tracking update needs, so memory use doesn't grow with the
+	number of Shipments and later batches are as cheap as the first.
+	"""
+	batch_size = frappe.conf.get("shipping_tracking_batch_size") or DEFAULT_BATCH_SIZE
+	filters = {
+		"docstatus": 1,
+		"status": "Booked",
+		"shipment_id": ["!=", ""],
+		"tracking_status": ["!=", "Delivered"],
+		# the others are polled by `enqueue_due_shipments` or done
+		"poll_state": ["is", "not set"],
+	}
+	while True:
+		if after:
+			filters["name"] = [">", after]
+
+		batch = frappe.get_all(
+			"Shipment", filters=filters, fields=SHIPMENT_FIELDS, order_by="name asc", limit=batch_size
+		)
+		if not batch:
+			return
+
+		yield batch
+		after = batch[-1].name
+
+
+def enqueue_due_shipments():
+	"""Enqueue the tracking update of all Shipments whose next poll is due. Runs every five minutes."""
+	resume_tracking_sweep()
+
+	shipments = frappe.get_all(
+		"Shipment",
+		filters={"status": "Booked", "docstatus": 1, "next_poll_at": ["<=", now_datetime()]},
+		order_by="next_poll_at asc",
+		limit=frappe.conf.get("shipping_tracking_max_due") or DEFAULT_MAX_DUE,
+		pluck="name",
+	)
+	if not shipments:
+		return
+
+	# keep the next ticks from enqueueing them again, the jobs set the actual next poll
+	frappe.db.set_value(
+		"Shipment",
+		{"name": ["in", shipments]},
+		"next_poll_at",
+		add_to_date(now_datetime(), seconds=BATCH_TIMEOUT),
+		update_modified=False,
+	)
+	enqueue_tracking_batches(shipments)
+
+
+def enqueue_tracking_batches(shipments: list[str]):
+	batch_size = frappe.conf.get("shipping_tracking_batch_size") or DEFAULT_BATCH_SIZE
+	for batch in create_batch(shipments, batch_size):
+		frappe.enqueue(
+			"erpnext_shipping.erpnext_shipping.tracking.update_tracking_for_shipments",
+			queue="long",
+			timeout=BATCH_TIMEOUT,
+			shipments=list(batch),
+		)
+
+
+def update_tracking_for_shipments(shipments: list[str], priority: str = rate_limiter.BACKGROUND) -> list[str]:
+	"""Update the tracking info of a batch of Shipments. Returns the Shipments that were updated."""
+	return update_tracking_for_rows(
+		frappe.get_all("Shipment", filters={"name": ["in", shipments]}, fields=SHIPMENT_FIELDS),
+		priority=priority,
+	)
+
+
+def update_tracking_for_rows(rows: list[dict], priority: str = rate_limiter.BACKGROUND) -> list[str]:
+	"""Update the tracking info of a batch of Shipments, given their `SHIPMENT_FIELDS`.
+
+	All provider calls of the batch run concurrently on one event loop, the
+	results are written afterwards together with the time of each Shipment's
+	next poll. The Shipment's tracking fields and its Delivery Notes are only
+	written if the tracking info changed, which is also recorded as Shipment
+	Tracking Events. Shipments that another worker is already updating are
+	skipped, the others are returned.
+	"""
+	from erpnext_shipping.erpnext_shipping.shipping import set_tracking_info
+
+	shipment_docs = {row.name: row for row in rows if acquire_tracking_lock(row.name)}
+	if not shipment_docs:
+		return []
+
+	shipments = list(shipment_docs)
+	try:
+		shipment_info = {
+			name: (shipment.service_provider, shipment.shipment_id)
+			for name, shipment in shipment_docs.items()
+		}
+		tracking_data = run_sync(fetch_tracking_data(shipment_info, priority))
+		changed_shipments = {
+			shipment: data
+			for shipment, data in tracking_data.items()
+			if data and get_content_hash(data) != get_content_hash(shipment_docs[shipment])
+		}
+
+		# Delivery Notes are only written when the tracking info changed
+		delivery_notes = {}
+		if changed_shipments:
+			for row in frappe.get_all(
+				"Shipment Delivery Note",
+				filters={"parenttype": "Shipment", "parent": ["in", list(changed_shipments)]},
+				fields=["parent", "delivery_note"],
+			):
+				delivery_notes.setdefault(row.parent, []).append(row.delivery_note)
+
+		for shipment, data in tracking_data.items():
+			previous = shipment_docs[shipment]
+			write_buffer = DocumentWriteBuffer()
+			if shipment in changed_shipments:
+				set_tracking_info(shipment, data, delivery_notes.get(shipment), write_buffer=write_buffer)
+				backoff = 0
+			else:
+				data, backoff = previous, (previous.poll_backoff or 0) + 1
+
+			# an unchanged poll is not a change of the document
+			write_buffer.set_value(
+				"Shipment", shipment, get_poll_values(data, backoff), update_modified=False
+			)
+			try:
+				write_buffer.flush()
+			except Exception:
+				changed_shipments.pop(shipment, None)
+				frappe.log_error(
+					title="Shipping Error", reference_doctype="Shipment", reference_name=shipment
+				)
+
+		try:
+			record_tracking_events(
+				{
+					shipment: (shipment_docs[shipment].shipment_id, data)
+					for shipment, data in changed_shipments.items()
+				}
+			)
+		except Exception:
+			frappe.log_error(title="Shipping Error")
+	finally:
+		for shipment in shipments:
+			release_tracking_lock(shipment)
+
+	return shipments
+
+
+def get_poll_values(tracking_info: dict, backoff: int = 0) -> dict:
+	"""Return the `poll_state`, `next_poll_at` and `poll_backoff` of a Shipment with this tracking info.
+
+	`backoff` is the number of polls in a row that didn't change the tracking
+	info. Delivered Shipments are not polled anymore.
+	"""
+	state = get_poll_state(tracking_info)
+	if state == DELIVERED:
+		return {"poll_state": state, "next_poll_at": None, "poll_backoff": 0}
+
+	backoff = min(backoff, MAX_POLL_BACKOFF)
+	interval = min(POLL_INTERVALS[state] * 2**backoff, MAX_POLL_INTERVAL)
+	return {
+		"poll_state": state,
+		"next_poll_at": add_to_date(now_datetime(), seconds=interval),
+		"poll_backoff": backoff,
+	}
+
+
+def get_poll_state(tracking_info: dict) -> str:
+	"""Return the key of `POLL_INTERVALS` that applies, or `DELIVERED` if all parcels are delivered."""
+	tracking_status = tracking_info.get("tracking_status")
+	if not tracking_status:
+		return "booked"
+
+	if all(status == "Delivered" for status in tracking_status.split(", ")):
+		return DELIVERED
+
+	status_info = f"{tracking_status} {tracking_info.get('tracking_status_info') or ''}"
+	status_info = status_info.lower().replace("_", " ").replace("-", "")
+	if any(status in status_info for status in EXCEPTION_STATUSES):
+		return "exception"
+	if any(status in status_info for status in NEAR_DELIVERY_STATUSES):
+		return "near_delivery"
+
+	return "in_transit"
+
+
+def schedule_awb_lookup(shipment: str):
+	"""Fetch the AWB number and tracking info of a just booked Shipment in the background.
+
+	Carriers assign AWB numbers some time after booking, so the lookup is
+	retried with growing delays until the number is there.
+	"""
+	cache = frappe.cache()
+	cache.zadd(cache.make_key(AWB_PENDING_KEY), {shipment: time.time()})
+	frappe.enqueue(
+		"erpnext_shipping.erpnext_shipping.tracking.lookup_pending_awb_numbers",
+		queue="short",
+		job_id=AWB_PENDING_KEY,
+		deduplicate=True,
+		enqueue_after_commit=True,
+	)
+
+
+def lookup_pending_awb_numbers():
+	"""Update the tracking info of all Shipments whose AWB lookup is due. Also runs every minute."""
+	cache = frappe.cache()
+	pending_key = cache.make_key(AWB_PENDING_KEY)
+	attempts_key = cache.make_key(AWB_ATTEMPTS_KEY)
+	shipments = [
+		frappe.safe_decode(shipment) for shipment in cache.zrangebyscore(pending_key, 0, time.time())
+	]
+	if not shipments:
+		return
+
+	update_tracking_for_shipments(shipments)
+
+	awb_numbers = dict(
+		frappe.get_all(
+			"Shipment", filters={"name": ["in", shipments]}, fields=["name", "awb_number"], as_list=True
+		)
+	)
+	finished = []
+	for shipment in shipments:
+		if awb_numbers.get(shipment):
+			notify_tracking_update(shipment)
+			attempts = MAX_AWB_ATTEMPTS
+		elif shipment not in awb_numbers:
+			# deleted in the meantime
+			attempts = MAX_AWB_ATTEMPTS
+		else:
+			attempts = cache.hincrby(attempts_key, shipment, 1)
+
+		if attempts >= MAX_AWB_ATTEMPTS:
+			# without an AWB number after all attempts, the daily sweep takes over
+			finished.append(shipment)
+		else:
+			delay = min(AWB_RETRY_DELAY * 2 ** (attempts - 1), MAX_AWB_RETRY_DELAY)
+			cache.zadd(pending_key, {shipment: time.time() + delay})
+
+	# the keys already carry the site prefix, so they go through the raw redis
+	# commands only, the wrapper's `hdel` would prefix them again
+	pipeline = cache.pipeline()
+	if finished:
+		pipeline.zrem(pending_key, *finished)
+		pipeline.hdel(attempts_key, *finished)
+	pipeline.expire(attempts_key, MAX_AWB_RETRY_DELAY * MAX_AWB_ATTEMPTS)
+	pipeline.execute()
+
+
+def update_parcel_tracking(shipment: str, parcel_id: str, parcel_tracking_info: dict):
+	"""Update the tracking info of one parcel of a Shipment and its Delivery Notes, if it changed.
+
+	The parcel is matched by its id, or else by its tracking number. Parcels that
+	are not part of the Shipment are ignored.
+	"""
+	from erpnext_shipping.erpnext_shipping.shipping import update_delivery_note
+
+	shipment_doc = frappe.db.get_value("Shipment", shipment, ["shipment_id", *TRACKING_FIELDS], as_dict=True)
+	parcels = split_parcel_tracking_info(shipment_doc.shipment_id, shipment_doc)
+	parcel = get_parcel(parcels, parcel_id, parcel_tracking_info.get("awb_number"))
+	if not parcel or get_content_hash(parcel) == get_content_hash(parcel_tracking_info):
+		return
+
+	parcel.update({field: parcel_tracking_info.get(field) or "" for field in TRACKING_FIELDS})
+	tracking_info = {field: ", ".join(parcel[field] for parcel in parcels) for field in TRACKING_FIELDS}
+
+	write_buffer = DocumentWriteBuffer()
+	write_buffer.set_value("Shipment", shipment, {**tracking_info, **get_poll_values(tracking_info)})
+	delivery_notes = frappe.get_all(
+		"Shipment Delivery Note",
+		filters={"parenttype": "Shipment", "parent": shipment},
+		pluck="delivery_note",
+	)
+	if delivery_notes:
+		update_delivery_note(
+			delivery_notes=delivery_notes, tracking_info=tracking_info, write_buffer=write_buffer
+		)
+
+	write_buffer.flush()
+	record_tracking_events({shipment: (shipment_doc.shipment_id, tracking_info)})
+
+	notify_tracking_update(shipment)
+
+
+def get_parcel(parcels: list[dict], parcel_id: str, awb_number: str | None = None) -> dict | None:
+	"""Return the parcel with this id, or else the one with this AWB number."""
+	for parcel in parcels:
+		if parcel["parcel_id"] == parcel_id:
+			return parcel
+
+	if awb_number:
+		for parcel in parcels:
+			if parcel["awb_number"] == awb_number:
+				return parcel
+
+	return None
+
+
+def record_tracking_events(tracking_info: dict[str, tuple[str, dict]]):
+	"""Append a Shipment Tracking Event for every parcel whose tracking info changed.
+
+	`tracking_info` maps Shipment names to their `shipment_id` and tracking info.
+	A parcel's info is compared with its latest event by the content hash.
+	"""
+	if not tracking_info:
+		return
+
+	latest_hashes = {}
+	for event in frappe.get_all(
+		"Shipment Tracking Event",
+		filters={"shipment": ["in", list(tracking_info)]},
+		fields=["shipment", "parcel_id", "content_hash"],
+		order_by="creation asc",
+	):
+		latest_hashes[(event.shipment, event.parcel_id)] = event.content_hash
+
+	now = now_datetime()
+	user = frappe.session.user
+	events = []
+	for shipment, (shipment_id, info) in tracking_info.items():
+		for parcel in split_parcel_tracking_info(shipment_id, info):
+			content_hash = get_content_hash(parcel)
+			if latest_hashes.get((shipment, parcel["parcel_id"])) == content_hash:
+				continue
+
+			events.append(
+				(
+					frappe.generate_hash(length=10),
+					now,
+					now,
+					user,
+					user,
+					shipment,
+					parcel["parcel_id"],
+					*(parcel[field] for field in TRACKING_FIELDS),
+					content_hash,
+				)
+			)
+
+	if events:
+		frappe.db.bulk_insert("Shipment Tracking Event", EVENT_FIELDS, events)
+
+
+def split_parcel_tracking_info(shipment_id: str, tracking_info: dict) -> list[dict]:
+	"""Return the tracking info of each parcel of a Shipment.
+
+	The tracking fields of multi parcel Shipments hold one comma separated value
+	per parcel, in the same order as the parcel ids in `shipment_id`.
+	"""
+	parcel_ids = (shipment_id or "").split(", ")
+	values = {}
+	for field in TRACKING_FIELDS:
+		value = tracking_info.get(field) or ""
+		# the value of a single parcel may contain commas itself
+		field_values = value.split(", ") if len(parcel_ids) > 1 else [value]
+		values[field] = (field_values + [""] * len(parcel_ids))[: len(parcel_ids)]
+
+	return [
+		{"parcel_id": parcel_id, **{field: values[field][idx] for field in TRACKING_FIELDS}}
+		for idx, parcel_id in enumerate(parcel_ids)
+	]
+
+
+def get_content_hash(tracking_info: dict) -> str:
+	"""Return a hash of the tracking fields, to tell whether the tracking info changed."""
+	content = "\x1f".join(tracking_info.get(field) or "" for field in TRACKING_FIELDS)
+	return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+
+def notify_tracking_update(shipment: str):
+	"""Let open forms of the Shipment know that its tracking info changed."""
+	frappe.publish_realtime(
+		"shipment_tracking_update",
+		{"shipment": shipment},
+		doctype="Shipment",
+		docname=shipment,
+		after_commit=True,
+	)
+
+
+def acquire_tracking_lock(shipment: str) -> bool:
+	cache = frappe.cache()
+	return bool(cache.set(cache.make_key(f"{TRACKING_LOCK_KEY}::{shipment}"), 1, nx=True, ex=BATCH_TIMEOUT))
+
+
+def release_tracking_lock(shipment: str):
+	cache = frappe.cache()
+	cache.delete(cache.make_key(f"{TRACKING_LOCK_KEY}::{shipment}"))
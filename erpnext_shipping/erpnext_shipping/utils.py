@@ -1,7 +1,13 @@
 # Copyright (c) 2020, Frappe Technologies and contributors
 # For license information, please see license.txt
+import copy
+import io
+import re
+import sys
+
 import frappe
 from frappe import _
+from frappe.utils.caching import request_cache
 from frappe.utils.data import get_link_to_form
 
 
@@ -14,7 +20,24 @@ def get_tracking_url(carrier, tracking_number):
 	return tracking_url
 
 
+ADDRESS_CACHE_KEY = "shipping_address"
+CONTACT_CACHE_KEY = "shipping_contact"
+COUNTRY_CODES_CACHE_KEY = "shipping_country_codes"
+
+
 def get_address(address_name):
+	# Resolved addresses are cached, callers get a copy they are free to modify
+	return copy.deepcopy(get_resolved_address(address_name))
+
+
+@request_cache
+def get_resolved_address(address_name):
+	return frappe.cache().hget(
+		ADDRESS_CACHE_KEY, address_name, generator=lambda: resolve_address(address_name)
+	)
+
+
+def resolve_address(address_name):
 	address = frappe.db.get_value(
 		"Address",
 		address_name,
@@ -47,13 +70,33 @@ def validate_address(address):
 
 
 def get_country_code(country_name):
-	country_code = frappe.db.get_value("Country", country_name, "code")
+	country_code = get_country_codes().get(country_name)
 	if not country_code:
 		frappe.throw(_("Country Code not found for {0}").format(country_name))
 	return country_code
 
 
+def get_country_codes() -> dict:
+	"""Return {country: ISO code} for all countries."""
+	return frappe.cache().get_value(
+		COUNTRY_CODES_CACHE_KEY,
+		generator=lambda: dict(frappe.get_all("Country", fields=["name", "code"], as_list=True)),
+	)
+
+
 def get_contact(contact_name):
+	# Resolved contacts are cached, callers get a copy they are free to modify
+	return copy.deepcopy(get_resolved_contact(contact_name))
+
+
+@request_cache
+def get_resolved_contact(contact_name):
+	return frappe.cache().hget(
+		CONTACT_CACHE_KEY, contact_name, generator=lambda: resolve_contact(contact_name)
+	)
+
+
+def resolve_contact(contact_name):
 	fields = ["first_name", "last_name", "email_id", "phone", "mobile_no", "gender"]
 	contact = frappe.db.get_value("Contact", contact_name, fields, as_dict=1)
 
@@ -66,26 +109,135 @@ def get_contact(contact_name):
 	if not contact.phone:
 		contact.phone = contact.mobile_no
 
+	contact.phone_prefix, contact.phone_number = parse_phone(contact.phone)
 	return contact
 
 
+def get_company_contact(user):
+	# Company contacts are built from the User, so they are only memoized per request
+	return copy.deepcopy(get_resolved_company_contact(user))
+
+
+@request_cache
+def get_resolved_company_contact(user):
+	from erpnext.stock.doctype.shipment.shipment import get_company_contact
+
+	contact = get_company_contact(user=user)
+	contact.email_id = contact.pop("email", None)
+	contact.phone_prefix, contact.phone_number = parse_phone(contact.phone)
+	return contact
+
+
+def get_shipment_contacts(pickup_from_type, delivery_to_type, pickup_contact_name, delivery_contact_name):
+	"""Return the pickup and delivery contact of a Shipment."""
+	if pickup_from_type != "Company":
+		pickup_contact = get_contact(pickup_contact_name)
+	else:
+		pickup_contact = get_company_contact(user=pickup_contact_name)
+
+	if delivery_to_type != "Company":
+		delivery_contact = get_contact(delivery_contact_name)
+	else:
+		delivery_contact = get_company_contact(user=pickup_contact_name)
+
+	return pickup_contact, delivery_contact
+
+
+def parse_phone(phone) -> tuple:
+	"""Split a phone number into its (international) prefix and the remaining digits."""
+	if not phone:
+		return None, None
+
+	return phone[:3], re.sub("[^A-Za-z0-9]+", "", phone[3:])
+
+
+def clear_address_cache(doc, method=None):
+	frappe.cache().hdel(ADDRESS_CACHE_KEY, doc.name)
+
+
+def clear_contact_cache(doc, method=None):
+	frappe.cache().hdel(CONTACT_CACHE_KEY, doc.name)
+
+
+def clear_country_cache(doc, method=None):
+	frappe.cache().delete_value(COUNTRY_CODES_CACHE_KEY)
+	# resolved addresses carry the country code
+	frappe.cache().delete_value(ADDRESS_CACHE_KEY)
+
+
 def match_parcel_service_type_carrier(shipment_prices: list[dict], carrier_fieldname: str, service_fieldname: str):
 	from erpnext_shipping.erpnext_shipping.doctype.parcel_service_type.parcel_service_type import (
-		match_parcel_service_type_alias,
+		get_index_key,
+		get_parcel_service_type_index,
 	)
 
-	for idx, prices in enumerate(shipment_prices):
-		service_name = match_parcel_service_type_alias(prices.get(carrier_fieldname), prices.get(service_fieldname))
-		is_preferred = frappe.db.get_value(
-			"Parcel Service Type", service_name, "show_in_preferred_services_list"
+	parcel_service_type_index = get_parcel_service_type_index()
+	for prices in shipment_prices:
+		match = parcel_service_type_index.get(
+			get_index_key(prices.get(carrier_fieldname), prices.get(service_fieldname))
 		)
-		if is_preferred:
-			shipment_prices[idx].is_preferred = is_preferred
+		if match and match[1]:
+			prices.is_preferred = match[1]
 
 	return shipment_prices
 
 
+class DocumentWriteBuffer:
+	"""Collect field changes and write them with as few UPDATE statements as possible.
+
+	All changes to a document are written with one UPDATE. Documents of the
+	same DocType that receive identical values (e.g. all Delivery Notes of a
+	Shipment) are written together with one UPDATE.
+	"""
+
+	def __init__(self):
+		self.changes = {}
+		# documents with at least one change that should update `modified`
+		self.modified = set()
+
+	def set_value(self, doctype: str, name: str, values: dict, update_modified: bool = True):
+		self.changes.setdefault((doctype, name), {}).update(values)
+		if update_modified:
+			self.modified.add((doctype, name))
+
+	def flush(self):
+		batches = {}
+		for (doctype, name), values in self.changes.items():
+			update_modified = (doctype, name) in self.modified
+			batches.setdefault((doctype, tuple(values.items()), update_modified), []).append(name)
+
+		for (doctype, values, update_modified), names in batches.items():
+			filters = names[0] if len(names) == 1 else {"name": ["in", names]}
+			frappe.db.set_value(doctype, filters, dict(values), update_modified=update_modified)
+
+		self.changes = {}
+		self.modified = set()
+
+
+def merge_pdfs(paths: list[str]) -> bytes:
+	"""Return a single PDF with the pages of all PDF files in `paths`, in order."""
+	try:
+		from pypdf import PdfReader, PdfWriter
+	except ImportError:  # Frappe v14 ships PyPDF2
+		from PyPDF2 import PdfReader, PdfWriter
+
+	writer = PdfWriter()
+	for path in paths:
+		for page in PdfReader(path).pages:
+			writer.add_page(page)
+
+	output = io.BytesIO()
+	writer.write(output)
+	return output.getvalue()
+
+
 def show_error_alert(action):
+	from erpnext_shipping.erpnext_shipping.circuit_breaker import ProviderUnavailableError
+
+	if isinstance(sys.exc_info()[1], ProviderUnavailableError):
+		# nothing was sent and the exception already told the user
+		return
+
 	log = frappe.log_error(title="Shipping Error")
 	link_to_log = get_link_to_form("Error Log", log.name, "See what happened.")
 	frappe.msgprint(
@@ -98,29 +250,10 @@ def show_error_alert(action):
 def update_tracking_info_daily():
 	"""Daily scheduled event to update Tracking info for not delivered Shipments
 
-	Also Updates the related Delivery Notes.
+	Also Updates the related Delivery Notes. Only Shipments without a scheduled
+	poll are updated here, the others are polled by `tracking.enqueue_due_shipments`.
+	The Shipments are split into batches that are processed by separate background jobs.
 	"""
-	from erpnext_shipping.erpnext_shipping.shipping import update_tracking
-
-	shipments = frappe.get_all(
-		"Shipment",
-		filters={
-			"docstatus": 1,
-			"status": "Booked",
-			"shipment_id": ["!=", ""],
-			"tracking_status": ["!=", "Delivered"],
-		},
-	)
-	for shipment in shipments:
-		shipment_doc = frappe.get_doc("Shipment", shipment.name)
-		tracking_info = update_tracking(
-			shipment.name,
-			shipment_doc.service_provider,
-			shipment_doc.shipment_id,
-			shipment_doc.shipment_delivery_notes,
-		)
+	from erpnext_shipping.erpnext_shipping.tracking import enqueue_tracking_sweep
 
-		if tracking_info:
-			fields = ["awb_number", "tracking_status", "tracking_status_info", "tracking_url"]
-			for field in fields:
-				shipment_doc.db_set(field, tracking_info.get(field))
+	enqueue_tracking_sweep()
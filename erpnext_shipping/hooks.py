@@ -32,7 +32,7 @@ app_include_js = "shipping.bundle.js"
 
 # include js in doctype views
 doctype_js = {"Shipment": "public/js/shipment.js"}
-# doctype_list_js = {"doctype" : "public/js/doctype_list.js"}
+doctype_list_js = {"Shipment": "public/js/shipment_list.js"}
 # doctype_tree_js = {"doctype" : "public/js/doctype_tree.js"}
 # doctype_calendar_js = {"doctype" : "public/js/doctype_calendar.js"}
 
@@ -89,18 +89,54 @@ after_install = "erpnext_shipping.install.after_install"
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-# }
-# }
+doc_events = {
+	"Address": {
+		"on_update": "erpnext_shipping.erpnext_shipping.utils.clear_address_cache",
+		"on_trash": "erpnext_shipping.erpnext_shipping.utils.clear_address_cache",
+	},
+	"Contact": {
+		"on_update": "erpnext_shipping.erpnext_shipping.utils.clear_contact_cache",
+		"on_trash": "erpnext_shipping.erpnext_shipping.utils.clear_contact_cache",
+	},
+	"Country": {
+		"on_update": "erpnext_shipping.erpnext_shipping.utils.clear_country_cache",
+		"on_trash": "erpnext_shipping.erpnext_shipping.utils.clear_country_cache",
+	},
+}
+
+# Request and Job Events
+# ----------------------
+# Write the provider metrics collected by this process to Redis
+
+after_request = ["erpnext_shipping.erpnext_shipping.metrics.flush_if_due"]
+after_job = ["erpnext_shipping.erpnext_shipping.metrics.flush_if_due"]
 
 # Scheduled Tasks
 # ---------------
 
-scheduler_events = {"daily": ["erpnext_shipping.erpnext_shipping.utils.update_tracking_info_daily"]}
+scheduler_events = {
+	"cron": {
+		"* * * * *": ["erpnext_shipping.erpnext_shipping.tracking.lookup_pending_awb_numbers"],
+		"*/5 * * * *": ["erpnext_shipping.erpnext_shipping.tracking.enqueue_due_shipments"],
+	},
+	"daily": ["erpnext_shipping.erpnext_shipping.utils.update_tracking_info_daily"],
+}
+
+# Shipping Rate Providers
+# -----------------------
+# Queried concurrently by `fetch_shipping_rates`. Keys are the provider's Single
+# settings DocType (with an `enabled` field), values return rates for a request.
+
+shipping_rate_providers = {
+	"LetMeShip": "erpnext_shipping.erpnext_shipping.doctype.letmeship.letmeship.get_letmeship_rates",
+	"SendCloud": "erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud.get_sendcloud_rates",
+}
+
+# Async provider engines, used to run many provider calls on one event loop
+shipping_async_providers = {
+	"LetMeShip": "erpnext_shipping.erpnext_shipping.doctype.letmeship.letmeship.get_async_letmeship",
+	"SendCloud": "erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud.get_async_sendcloud",
+}
 
 # Testing
 # -------
@@ -195,5 +231,35 @@ shipping_custom_fields = {
 			"translatable": 0,
 			"insert_after": "tracking_status",
 		},
-	]
+	],
+	"Shipment": [
+		{
+			"fieldname": "poll_state",
+			"label": "Tracking Update State",
+			"fieldtype": "Data",
+			"read_only": 1,
+			"hidden": 1,
+			"no_copy": 1,
+			"translatable": 0,
+			"insert_after": "tracking_status_info",
+		},
+		{
+			"fieldname": "next_poll_at",
+			"label": "Next Tracking Update",
+			"fieldtype": "Datetime",
+			"read_only": 1,
+			"hidden": 1,
+			"no_copy": 1,
+			"insert_after": "poll_state",
+		},
+		{
+			"fieldname": "poll_backoff",
+			"label": "Tracking Updates Without Change",
+			"fieldtype": "Int",
+			"read_only": 1,
+			"hidden": 1,
+			"no_copy": 1,
+			"insert_after": "next_poll_at",
+		},
+	],
 }
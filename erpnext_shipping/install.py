@@ -1,3 +1,4 @@
+import frappe
 from frappe import get_hooks
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 
@@ -5,3 +6,16 @@ from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 def after_install():
 	custom_fields = get_hooks("shipping_custom_fields")
 	create_custom_fields(custom_fields)
+	add_shipment_indexes()
+	add_shipment_polling_index()
+
+
+def add_shipment_indexes():
+	# Shipment is an ERPNext DocType, so the indexes can't be declared in its JSON
+	frappe.db.add_index("Shipment", ["shipment_id"])
+	frappe.db.add_index("Shipment", ["awb_number"])
+
+
+def add_shipment_polling_index():
+	# due Shipments are looked up by `tracking.enqueue_due_shipments`, needs the custom fields
+	frappe.db.add_index("Shipment", ["status", "docstatus", "next_poll_at"])
@@ -1,7 +1,19 @@
 // Copyright (c) 2020, Frappe and contributors
 // For license information, please see license.txt
 
+// Milliseconds to wait for streamed rates before fetching them directly,
+// longer than the server's default budget for all providers.
+const RATE_QUOTE_TIMEOUT = 30 * 1000;
+
 frappe.ui.form.on('Shipment', {
+	setup: function(frm) {
+		frappe.realtime.on('shipment_tracking_update', (data) => {
+			if (data.shipment === frm.doc.name && !frm.is_dirty()) {
+				frm.reload_doc();
+			}
+		});
+	},
+
 	refresh: function(frm) {
 		if (frm.doc.docstatus === 1 && !frm.doc.shipment_id) {
 			frm.add_custom_button(__('Fetch Shipping Rates'), function() {
@@ -14,7 +26,7 @@ frappe.ui.form.on('Shipment', {
 			}, __('Tools'));
 			if (frm.doc.tracking_status != 'Delivered') {
 				frm.add_custom_button(__('Update Tracking'), function() {
-					return frm.events.update_tracking(frm, frm.doc.service_provider, frm.doc.shipment_id);
+					return frm.events.update_tracking(frm);
 				}, __('Tools'));
 
 				frm.add_custom_button(__('Track Status'), function() {
@@ -31,39 +43,112 @@ frappe.ui.form.on('Shipment', {
 	},
 
 	fetch_shipping_rates: function(frm) {
-		if (!frm.doc.shipment_id) {
+		if (frm.doc.shipment_id) {
+			frappe.throw(__("Shipment already created"));
+		}
+
+		// Rates are streamed per provider, the dialog opens with the fastest one.
+		const quote_id = frappe.utils.get_random(10);
+		const args = {
+			pickup_from_type: frm.doc.pickup_from_type,
+			delivery_to_type: frm.doc.delivery_to_type,
+			pickup_address_name: frm.doc.pickup_address_name,
+			delivery_address_name: frm.doc.delivery_address_name,
+			parcels: frm.doc.shipment_parcel,
+			description_of_content: frm.doc.description_of_content,
+			pickup_date: frm.doc.pickup_date,
+			pickup_contact_name: frm.doc.pickup_from_type === 'Company' ? frm.doc.pickup_contact_person : frm.doc.pickup_contact_name,
+			delivery_contact_name: frm.doc.delivery_contact_name,
+			value_of_goods: frm.doc.value_of_goods
+		};
+		let service_selector = null;
+		let finished = false;
+		let fallback_timer = null;
+
+		const finish = () => {
+			finished = true;
+			clearTimeout(fallback_timer);
+			frappe.realtime.off("shipping_rates", on_rates);
+			frappe.dom.unfreeze();
+		};
+
+		const show_rates = (rates, skipped_providers) => {
+			if (rates && rates.length) {
+				if (!service_selector) {
+					// the user isn't blocked anymore, the remaining providers may take their time
+					clearTimeout(fallback_timer);
+					frappe.dom.unfreeze();
+					service_selector = select_from_available_services(frm, []);
+				}
+				service_selector.add_services(rates);
+			}
+			if (skipped_providers === undefined) return;
+
+			// the quote is complete
+			finish();
+			const skipped = __("Skipped providers: {0}", [(skipped_providers || []).join(", ")]);
+			if (service_selector) {
+				if (skipped_providers && skipped_providers.length) {
+					frappe.show_alert({message: skipped, indicator: "orange"});
+				}
+			} else {
+				let message = __("No Shipment Services available");
+				if (skipped_providers && skipped_providers.length) {
+					message += "<br>" + skipped;
+				}
+				frappe.msgprint({message: message, title: __("Note")});
+			}
+		};
+
+		const on_rates = (data) => {
+			if (finished || data.quote_id !== quote_id) return;
+			show_rates(data.rates, data.done ? data.skipped_providers : undefined);
+		};
+
+		// Without any event in time (job delayed, no realtime connection), ask for the rates directly.
+		const fall_back_to_direct_fetch = () => {
+			if (finished || service_selector) return;
+
+			finish();
 			frappe.call({
 				method: "erpnext_shipping.erpnext_shipping.shipping.fetch_shipping_rates",
 				freeze: true,
 				freeze_message: __("Fetching Shipping Rates"),
-				args: {
-					pickup_from_type: frm.doc.pickup_from_type,
-					delivery_to_type: frm.doc.delivery_to_type,
-					pickup_address_name: frm.doc.pickup_address_name,
-					delivery_address_name: frm.doc.delivery_address_name,
-					parcels: frm.doc.shipment_parcel,
-					description_of_content: frm.doc.description_of_content,
-					pickup_date: frm.doc.pickup_date,
-					pickup_contact_name: frm.doc.pickup_from_type === 'Company' ? frm.doc.pickup_contact_person : frm.doc.pickup_contact_name,
-					delivery_contact_name: frm.doc.delivery_contact_name,
-					value_of_goods: frm.doc.value_of_goods
-				},
+				args: args,
 				callback: function(r) {
-					if (r.message && r.message.length) {
-						select_from_available_services(frm, r.message);
-					}
-					else {
-						frappe.msgprint({message:__("No Shipment Services available"), title:__("Note")});
-					}
+					show_rates(r.message || [], r.skipped_providers || []);
 				}
 			});
-		}
-		else {
-			frappe.throw(__("Shipment already created"));
-		}
+		};
+
+		frappe.realtime.on("shipping_rates", on_rates);
+		frappe.dom.freeze(__("Fetching Shipping Rates"));
+		frappe.call({
+			method: "erpnext_shipping.erpnext_shipping.shipping.start_shipping_rate_quote",
+			args: Object.assign({quote_id: quote_id}, args),
+			callback: function(r) {
+				if (r.message && r.message.done) {
+					// cached quote, no job was started
+					show_rates(r.message.rates, r.message.skipped_providers);
+				} else if (!finished && !service_selector) {
+					fallback_timer = setTimeout(fall_back_to_direct_fetch, RATE_QUOTE_TIMEOUT);
+				}
+			},
+			error: function() {
+				finish();
+			}
+		});
 	},
 
 	print_shipping_label: function(frm) {
+		if (frm.doc.service_provider == "LetMeShip") {
+			// served as PDF, the browser shows it without storing a copy
+			const url = "/api/method/erpnext_shipping.erpnext_shipping.shipping.download_shipping_label?shipment="
+				+ encodeURIComponent(frm.doc.name);
+			window.open(frappe.urllib.get_full_url(url));
+			return;
+		}
+
 		frappe.call({
 			method: "erpnext_shipping.erpnext_shipping.shipping.print_shipping_label",
 			freeze: true,
@@ -73,40 +158,19 @@ frappe.ui.form.on('Shipment', {
 			},
 			callback: function(r) {
 				if (r.message) {
-					if (frm.doc.service_provider == "LetMeShip") {
-						var array = JSON.parse(r.message);
-						// Uint8Array for unsigned bytes
-						array = new Uint8Array(array);
-						const file = new Blob([array], {type: "application/pdf"});
-						const file_url = URL.createObjectURL(file);
-						window.open(file_url);
-					}
-					else {
-						if (Array.isArray(r.message)) {
-							r.message.forEach(url => window.open(url));
-						} else {
-							window.open(r.message);
-						}
-					}
+					window.open(r.message);
 				}
 			}
 		});
 	},
 
-	update_tracking: function(frm, service_provider, shipment_id) {
-		let delivery_notes = [];
-		(frm.doc.shipment_delivery_note || []).forEach((d) => {
-			delivery_notes.push(d.delivery_note);
-		});
+	update_tracking: function(frm) {
 		frappe.call({
 			method: "erpnext_shipping.erpnext_shipping.shipping.update_tracking",
 			freeze: true,
 			freeze_message: __("Updating Tracking"),
 			args: {
-				shipment: frm.doc.name,
-				shipment_id: shipment_id,
-				service_provider: service_provider,
-				delivery_notes: delivery_notes
+				shipment: frm.doc.name
 			},
 			callback: function(r) {
 				if (!r.exc) {
@@ -118,14 +182,7 @@ frappe.ui.form.on('Shipment', {
 });
 
 function select_from_available_services(frm, available_services) {
-	const arranged_services = available_services.reduce((prev, curr) => {
-		if (curr.is_preferred) {
-			prev.preferred_services.push(curr);
-		} else {
-			prev.other_services.push(curr);
-		}
-		return prev;
-	}, { preferred_services: [], other_services: [] });
+	const arranged_services = { preferred_services: [], other_services: [] };
 
 	const dialog = new frappe.ui.Dialog({
 		title: __("Select Service to Create Shipment"),
@@ -143,21 +200,37 @@ function select_from_available_services(frm, available_services) {
 		delivery_notes.push(d.delivery_note);
 	});
 
-	dialog.fields_dict.available_services.$wrapper.html(
-		frappe.render_template(
-			'shipment_service_selector',
-			{
-				'header_columns': [
-					__("Platform"),
-					__("Carrier"),
-					__("Parcel Service"),
-					__("Price"),
-					""
-				],
-				'data': arranged_services
-			}
-		)
-	);
+	const render = () => {
+		dialog.fields_dict.available_services.$wrapper.html(
+			frappe.render_template(
+				'shipment_service_selector',
+				{
+					'header_columns': [
+						__("Platform"),
+						__("Carrier"),
+						__("Parcel Service"),
+						__("Price"),
+						""
+					],
+					'data': arranged_services
+				}
+			)
+		);
+	};
+
+	// Merge services into the preferred and other lists, keeping both sorted by price.
+	const add_services = (services) => {
+		services.forEach((service) => {
+			const services_of_type = service.is_preferred
+				? arranged_services.preferred_services
+				: arranged_services.other_services;
+			services_of_type.push(service);
+		});
+		Object.values(arranged_services).forEach(
+			(services_of_type) => services_of_type.sort((a, b) => a.total_price - b.total_price)
+		);
+		render();
+	};
 
 	dialog.$body.on('click', '.btn', function() {
 		let service_type = $(this).attr("data-type");
@@ -194,11 +267,12 @@ function select_from_available_services(frm, available_services) {
 							title: __("Shipment Created"),
 							indicator: "green"
 						});
-					frm.events.update_tracking(frm, r.message.service_provider, r.message.shipment_id);
 				}
 			}
 		});
 		dialog.hide();
 	};
+	add_services(available_services);
 	dialog.show();
+	return { dialog, add_services };
 }
\ No newline at end of file
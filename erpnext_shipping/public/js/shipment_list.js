@@ -0,0 +1,39 @@
+// Copyright (c) 2024, Frappe and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings['Shipment'] = frappe.listview_settings['Shipment'] || {};
+
+const erpnext_shipping_list_onload = frappe.listview_settings['Shipment'].onload;
+
+frappe.listview_settings['Shipment'].onload = function(listview) {
+	if (erpnext_shipping_list_onload) {
+		erpnext_shipping_list_onload(listview);
+	}
+
+	listview.page.add_actions_menu_item(__('Print Shipping Labels'), function() {
+		const shipments = listview.get_checked_items(true);
+		if (!shipments.length) {
+			frappe.throw(__('Please select the Shipments to print labels for.'));
+		}
+
+		frappe.call({
+			method: 'erpnext_shipping.erpnext_shipping.bulk_shipping.print_shipping_labels',
+			freeze: true,
+			freeze_message: __('Printing Shipping Labels'),
+			args: {
+				shipments: shipments
+			},
+			callback: function(r) {
+				if (r.message) {
+					window.open(r.message);
+				}
+			}
+		});
+	}, false);
+
+	frappe.realtime.on('shipping_labels_ready', (data) => {
+		if (data.file_url) {
+			window.open(data.file_url);
+		}
+	});
+};